@@ -0,0 +1,387 @@
+# Standalone ray casting without a Blender binary
+# export_scene() dumps a Blender scene (world-space triangles, face normals,
+# simpleRT_material, lights and camera) to an .npz file from inside Blender
+# BVHScene loads the file anywhere and casts rays with a NumPy BVH.
+# It has the same ray_cast() as bpy.types.Scene, so it can be passed as the
+# scene to trace_photons, render_map and RT_render_scene
+# BVHScene needs mathutils (pip install mathutils) for its objects, but the
+# BVH itself only needs numpy
+import numpy as np
+from time import time
+
+
+# Export the scene to an .npz file that BVHScene loads
+# Run it from Blender
+def export_scene(scene, path, depsgraph=None):
+    import bpy
+    if depsgraph is None:
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+
+    objects = list(scene.objects)
+    n = len(objects)
+    arrays = {
+        "object_names": np.array([o.name for o in objects]),
+        "object_types": np.array([o.type for o in objects]),
+        "object_locations": np.array([o.location for o in objects]).reshape(n, 3),
+        "object_rotations": np.array([o.rotation_euler for o in objects]).reshape(n, 3),
+        "object_rotation_modes": np.array([o.rotation_euler.order for o in objects]),
+        "object_matrices": np.array([o.matrix_world for o in objects]).reshape(n, 4, 4),
+        "mat_diffuse": np.zeros((n, 3)),
+        "mat_specular": np.zeros((n, 3)),
+        "mat_hardness": np.zeros(n),
+        "mat_mirror": np.zeros(n),
+        "mat_ior": np.ones(n),
+        "mat_fresnel": np.zeros(n, dtype=bool),
+        "mat_transmission": np.zeros(n),
+        "light_types": np.array([o.data.type if o.type == "LIGHT" else "" for o in objects]),
+        "light_energy": np.zeros(n),
+        "light_color": np.zeros((n, 3)),
+        "light_size": np.zeros(n),
+        "camera_index": objects.index(scene.camera),
+        "camera_lens": scene.camera.data.lens,
+        "camera_sensor_width": scene.camera.data.sensor_width,
+        "render_resolution": np.array([scene.render.resolution_x, \
+            scene.render.resolution_y, scene.render.resolution_percentage]),
+        "simpleRT_samples": scene.simpleRT.samples,
+        "simpleRT_recursion_depth": scene.simpleRT.recursion_depth,
+        "simpleRT_ambient_color": np.array(scene.simpleRT.ambient_color[:3]),
+    }
+
+    tri_verts = []
+    tri_norms = []
+    tri_objects = []
+    tri_faces = []
+    for i, o in enumerate(objects):
+        if o.type == "LIGHT":
+            arrays["light_energy"][i] = o.data.energy
+            arrays["light_color"][i] = o.data.color[:3]
+            arrays["light_size"][i] = o.data.size if o.data.type == "AREA" else 0
+        if o.type != "MESH":
+            continue
+
+        mat = o.simpleRT_material
+        arrays["mat_diffuse"][i] = mat.diffuse_color[:3]
+        arrays["mat_specular"][i] = mat.specular_color[:3]
+        arrays["mat_hardness"][i] = mat.specular_hardness
+        arrays["mat_mirror"][i] = mat.mirror_reflectivity
+        arrays["mat_ior"][i] = mat.ior
+        arrays["mat_fresnel"][i] = mat.use_fresnel
+        arrays["mat_transmission"][i] = mat.transmission
+
+        # world-space triangles of the evaluated mesh
+        evaluated = o.evaluated_get(depsgraph)
+        mesh = evaluated.to_mesh()
+        mesh.calc_loop_triangles()
+
+        verts = np.zeros(len(mesh.vertices) * 3)
+        mesh.vertices.foreach_get("co", verts)
+        tris = np.zeros(len(mesh.loop_triangles) * 3, dtype=np.int64)
+        mesh.loop_triangles.foreach_get("vertices", tris)
+        faces = np.zeros(len(mesh.loop_triangles), dtype=np.int64)
+        mesh.loop_triangles.foreach_get("polygon_index", faces)
+        face_norms = np.zeros(len(mesh.polygons) * 3)
+        mesh.polygons.foreach_get("normal", face_norms)
+        evaluated.to_mesh_clear()
+
+        matrix = np.array(o.matrix_world)
+        verts = verts.reshape(-1, 3) @ matrix[:3, :3].T + matrix[:3, 3]
+        # normals transform with the inverse transpose
+        norms = face_norms.reshape(-1, 3)[faces] @ np.linalg.inv(matrix[:3, :3])
+        norms /= np.linalg.norm(norms, axis=1, keepdims=True)
+
+        tri_verts.append(verts[tris.reshape(-1, 3)])
+        tri_norms.append(norms)
+        tri_objects.append(np.full(len(faces), i, dtype=np.int64))
+        tri_faces.append(faces)
+
+    arrays["tri_verts"] = np.concatenate(tri_verts) if tri_verts else np.zeros((0, 3, 3))
+    arrays["tri_norms"] = np.concatenate(tri_norms) if tri_norms else np.zeros((0, 3))
+    arrays["tri_objects"] = np.concatenate(tri_objects) if tri_objects else np.zeros(0, dtype=np.int64)
+    arrays["tri_faces"] = np.concatenate(tri_faces) if tri_faces else np.zeros(0, dtype=np.int64)
+
+    np.savez(path, **arrays)
+    print("Export triangles: ", len(arrays["tri_verts"]))
+
+
+# Surface area of (N, 3) boxes given by their min and max corners
+def box_area(box_min, box_max):
+    d = np.maximum(box_max - box_min, 0)
+    return 2 * (d[..., 0] * d[..., 1] + d[..., 1] * d[..., 2] + d[..., 2] * d[..., 0])
+
+
+# Bounding volume hierarchy over triangles, built with binned SAH
+# Nodes are stored in flat arrays; a node is a leaf when left == -1,
+# and then owns the triangles order[start:start + count]
+# Nodes up to leaf_size triangles are always leaves, nodes up to
+# max_leaf_size triangles become leaves when no split is cheaper
+class BVH():
+    def __init__(self, tri_verts, leaf_size=4, max_leaf_size=16, num_bins=16):
+        self.max_leaf_size = max_leaf_size
+        tri_verts = np.asarray(tri_verts, dtype=np.float64).reshape(-1, 3, 3)
+        self.v0 = tri_verts[:, 0]
+        self.e1 = tri_verts[:, 1] - tri_verts[:, 0]
+        self.e2 = tri_verts[:, 2] - tri_verts[:, 0]
+
+        tri_min = tri_verts.min(axis=1)
+        tri_max = tri_verts.max(axis=1)
+        centroids = tri_verts.mean(axis=1)
+        self.order = np.arange(len(tri_verts), dtype=np.int64)
+
+        box_min, box_max, axes, lefts, rights, starts, counts = [], [], [], [], [], [], []
+        def new_node(start, count):
+            box_min.append(np.zeros(3))
+            box_max.append(np.zeros(3))
+            axes.append(0)
+            lefts.append(-1)
+            rights.append(-1)
+            starts.append(start)
+            counts.append(count)
+            return len(starts) - 1
+
+        stack = [new_node(0, len(tri_verts))]
+        while stack:
+            node = stack.pop()
+            start, count = starts[node], counts[node]
+            tris = self.order[start:start + count]
+            if count == 0:
+                continue
+            box_min[node] = tri_min[tris].min(axis=0)
+            box_max[node] = tri_max[tris].max(axis=0)
+            if count <= leaf_size:
+                continue
+
+            split = self._sah_split(tri_min[tris], tri_max[tris], centroids[tris], num_bins)
+            if split is None:
+                continue  # keeping a leaf is cheaper than any split
+            axis, left_mask = split
+
+            self.order[start:start + count] = np.concatenate((tris[left_mask], tris[~left_mask]))
+            num_left = int(np.count_nonzero(left_mask))
+            axes[node] = axis
+            lefts[node] = new_node(start, num_left)
+            rights[node] = new_node(start + num_left, count - num_left)
+            stack.extend((lefts[node], rights[node]))
+
+        self.box_min = np.array(box_min).reshape(-1, 3)
+        self.box_max = np.array(box_max).reshape(-1, 3)
+        self.axes = np.array(axes, dtype=np.int64)
+        self.lefts = np.array(lefts, dtype=np.int64)
+        self.rights = np.array(rights, dtype=np.int64)
+        self.starts = np.array(starts, dtype=np.int64)
+        self.counts = np.array(counts, dtype=np.int64)
+
+    # Find the split with the lowest surface area heuristic cost
+    # Return (axis, mask of the triangles going left), or None for a leaf
+    def _sah_split(self, tri_min, tri_max, centroids, num_bins):
+        count = len(centroids)
+        leaf_cost = count * box_area(tri_min.min(axis=0), tri_max.max(axis=0))
+        best = None
+        best_cost = np.inf
+        c_min = centroids.min(axis=0)
+        extent = centroids.max(axis=0) - c_min
+
+        for axis in range(3):
+            if extent[axis] <= 0:
+                continue
+            bins = ((centroids[:, axis] - c_min[axis]) / extent[axis] * num_bins).astype(np.int64)
+            bins = np.minimum(bins, num_bins - 1)
+
+            bin_counts = np.bincount(bins, minlength=num_bins)
+            bin_min = np.full((num_bins, 3), np.inf)
+            bin_max = np.full((num_bins, 3), -np.inf)
+            np.minimum.at(bin_min, bins, tri_min)
+            np.maximum.at(bin_max, bins, tri_max)
+
+            # cost of splitting after each of the first num_bins - 1 bins
+            left_area = box_area(np.minimum.accumulate(bin_min)[:-1], np.maximum.accumulate(bin_max)[:-1])
+            right_area = box_area(np.minimum.accumulate(bin_min[::-1])[::-1][1:], \
+                np.maximum.accumulate(bin_max[::-1])[::-1][1:])
+            left_count = np.cumsum(bin_counts)[:-1]
+            costs = left_count * left_area + (count - left_count) * right_area
+            costs[(left_count == 0) | (left_count == count)] = np.inf
+
+            i = int(np.argmin(costs))
+            if costs[i] < best_cost:
+                best_cost = costs[i]
+                best = (axis, bins <= i)
+
+        if best is None:
+            # all centroids coincide, split in the middle of the list
+            left_mask = np.arange(count) < count // 2
+            return int(np.argmax(tri_max.max(axis=0) - tri_min.min(axis=0))), left_mask
+        if best_cost >= leaf_cost and count <= self.max_leaf_size:
+            return None
+        return best
+
+    # Intersect rays with the triangles, packet_size rays at a time
+    # Return the (N,) hit distances (inf for misses) and triangle ids (-1)
+    def intersect(self, origins, directions, packet_size=4096):
+        origins = np.asarray(origins, dtype=np.float64).reshape(-1, 3)
+        directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+        t_hit = np.full(len(origins), np.inf)
+        tri_hit = np.full(len(origins), -1, dtype=np.int64)
+        for start in range(0, len(origins), packet_size):
+            end = start + packet_size
+            t_hit[start:end], tri_hit[start:end] = \
+                self._intersect_packet(origins[start:end], directions[start:end])
+        return t_hit, tri_hit
+
+    # Traverse the BVH with a packet of rays
+    # A node is visited by the rays of the packet whose box test passes
+    def _intersect_packet(self, origins, directions):
+        n = len(origins)
+        t_hit = np.full(n, np.inf)
+        tri_hit = np.full(n, -1, dtype=np.int64)
+        if len(self.order) == 0:
+            return t_hit, tri_hit
+
+        safe = np.where(np.abs(directions) < 1e-12, 1e-12, directions)
+        inv_dirs = 1 / safe
+
+        stack = [(0, np.arange(n))]
+        while stack:
+            node, rays = stack.pop()
+
+            # slab test of the node box
+            t0 = (self.box_min[node] - origins[rays]) * inv_dirs[rays]
+            t1 = (self.box_max[node] - origins[rays]) * inv_dirs[rays]
+            t_near = np.maximum(np.minimum(t0, t1).max(axis=1), 0)
+            t_far = np.maximum(t0, t1).min(axis=1)
+            rays = rays[(t_near <= t_far) & (t_near < t_hit[rays])]
+            if len(rays) == 0:
+                continue
+
+            if self.lefts[node] != -1:
+                # visit the child nearer to the packet first
+                near, far = self.lefts[node], self.rights[node]
+                if directions[rays, self.axes[node]].sum() < 0:
+                    near, far = far, near
+                stack.append((far, rays))
+                stack.append((near, rays))
+                continue
+
+            # Moller-Trumbore test of all the rays against all the leaf triangles
+            tris = self.order[self.starts[node]:self.starts[node] + self.counts[node]]
+            d = directions[rays][:, None, :]
+            p = np.cross(d, self.e2[tris][None, :, :])
+            det = np.einsum("ijk,jk->ij", p, self.e1[tris])
+            ok = np.abs(det) > 1e-12
+            inv_det = 1 / np.where(ok, det, 1)
+            s = origins[rays][:, None, :] - self.v0[tris][None, :, :]
+            u = np.einsum("ijk,ijk->ij", s, p) * inv_det
+            q = np.cross(s, self.e1[tris][None, :, :])
+            v = np.einsum("ijk,ijk->ij", d, q) * inv_det
+            t = np.einsum("ijk,jk->ij", q, self.e2[tris]) * inv_det
+            ok &= (u >= 0) & (v >= 0) & (u + v <= 1) & (t > 1e-9)
+            t = np.where(ok, t, np.inf)
+
+            nearest = np.argmin(t, axis=1)
+            t_nearest = t[np.arange(len(rays)), nearest]
+            closer = t_nearest < t_hit[rays]
+            t_hit[rays[closer]] = t_nearest[closer]
+            tri_hit[rays[closer]] = tris[nearest[closer]]
+
+        return t_hit, tri_hit
+
+
+# A scene exported by export_scene(), with the attributes of bpy.types.Scene
+# the tracers use: objects, camera, render, simpleRT, view_layers and ray_cast()
+class BVHScene():
+    def __init__(self, path):
+        from types import SimpleNamespace
+        from mathutils import Vector, Matrix, Euler
+
+        arrays = np.load(path)
+        self.tri_verts = arrays["tri_verts"]
+        self.tri_norms = arrays["tri_norms"]
+        self.tri_objects = arrays["tri_objects"]
+        self.tri_faces = arrays["tri_faces"]
+
+        # objects with the properties the tracers read
+        self.objects = []
+        for i, name in enumerate(arrays["object_names"]):
+            o = SimpleNamespace(name=str(name), type=str(arrays["object_types"][i]))
+            o.location = Vector(arrays["object_locations"][i])
+            o.rotation_euler = Euler(arrays["object_rotations"][i], str(arrays["object_rotation_modes"][i]))
+            o.matrix_world = Matrix(arrays["object_matrices"][i].tolist())
+            if o.type == "MESH":
+                o.simpleRT_material = SimpleNamespace(
+                    diffuse_color=Vector(arrays["mat_diffuse"][i]),
+                    specular_color=Vector(arrays["mat_specular"][i]),
+                    specular_hardness=float(arrays["mat_hardness"][i]),
+                    mirror_reflectivity=float(arrays["mat_mirror"][i]),
+                    ior=float(arrays["mat_ior"][i]),
+                    use_fresnel=bool(arrays["mat_fresnel"][i]),
+                    transmission=float(arrays["mat_transmission"][i]))
+            elif o.type == "LIGHT":
+                o.data = SimpleNamespace(type=str(arrays["light_types"][i]),
+                    energy=float(arrays["light_energy"][i]),
+                    color=Vector(arrays["light_color"][i]),
+                    size=float(arrays["light_size"][i]))
+            self.objects.append(o)
+
+        self.camera = self.objects[int(arrays["camera_index"])]
+        self.camera.data = SimpleNamespace(lens=float(arrays["camera_lens"]), \
+            sensor_width=float(arrays["camera_sensor_width"]))
+        resolution_x, resolution_y, percentage = arrays["render_resolution"].tolist()
+        self.render = SimpleNamespace(resolution_x=resolution_x, \
+            resolution_y=resolution_y, resolution_percentage=percentage)
+        self.simpleRT = SimpleNamespace(samples=int(arrays["simpleRT_samples"]), \
+            recursion_depth=int(arrays["simpleRT_recursion_depth"]), \
+            ambient_color=Vector(arrays["simpleRT_ambient_color"]))
+        self.view_layers = [None]
+
+        t0 = time()
+        self.bvh = BVH(self.tri_verts)
+        print(f'Build BVH of {len(self.tri_verts)} triangles: {time() - t0: .2f} seconds.')
+
+    # same arguments and return values as bpy.types.Scene.ray_cast()
+    def ray_cast(self, view_layer, origin, direction):
+        from mathutils import Vector, Matrix
+        has_hit, hit_locs, hit_norms, indices, obj_indices = \
+            self.ray_cast_many(np.array([origin]), np.array([direction]))
+        if not has_hit[0]:
+            return False, Vector((0, 0, 0)), Vector((0, 0, 0)), -1, None, Matrix()
+        hit_obj = self.objects[obj_indices[0]]
+        return True, Vector(hit_locs[0]), Vector(hit_norms[0]), int(indices[0]), \
+            hit_obj, hit_obj.matrix_world
+
+    # same return values as rayTracing.ray_cast_many(), which calls it
+    def ray_cast_many(self, origins, directions):
+        directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+        directions = directions / np.linalg.norm(directions, axis=1, keepdims=True)
+        origins = np.broadcast_to(np.asarray(origins, dtype=np.float64), directions.shape)
+
+        t_hit, tris = self.bvh.intersect(origins, directions)
+        has_hit = tris >= 0
+        t_hit = np.where(has_hit, t_hit, 0)
+        hit_locs = np.where(has_hit[:, None], origins + t_hit[:, None] * directions, 0)
+        hit_norms = np.where(has_hit[:, None], self.tri_norms[tris], 0)
+        indices = np.where(has_hit, self.tri_faces[tris], -1)
+        obj_indices = np.where(has_hit, self.tri_objects[tris], -1)
+        return has_hit, hit_locs, hit_norms, indices, obj_indices
+
+
+# Time building the BVH of an exported scene and casting random rays in it
+def profile(scene_path, num_rays):
+    num_rays = int(num_rays)
+
+    t0 = time()
+    scene = BVHScene(scene_path)
+    t1 = time()
+
+    origins = np.tile(np.array(scene.camera.location), (num_rays, 1))
+    directions = np.random.randn(num_rays, 3)
+    has_hit = scene.ray_cast_many(origins, directions)[0]
+
+    t2 = time()
+
+    print("==========================")
+    print(f'Profile result of {len(scene.tri_verts)} triangles, num_rays {num_rays}')
+    print(f'Load scene and build BVH: {t1 - t0: .2f} seconds.')
+    print(f'Cast rays: {t2 - t1: .2f} seconds, {np.count_nonzero(has_hit)} hits.')
+    print("==========================")
+
+
+if __name__ == "__main__":
+    pass
@@ -1,5 +1,8 @@
 # Functions for path tracing which builds the photon map
-import bpy
+try:
+    import bpy
+except ImportError:  # headless, trace a bvh.BVHScene
+    bpy = None
 
 import importlib
 import photonMap
@@ -20,9 +23,10 @@ from rayTracing import *
 eps = 0.003
 
 # Show the objects in the scene for debug
-def print_scene():
+def print_scene(scene=None):
     print("============= Scene Objects =============")
-    scene = bpy.context.scene
+    if scene is None:
+        scene = bpy.context.scene
     objs = scene.objects
     for o in objs:
         print(o.type, o.name)
@@ -31,135 +35,274 @@ def print_scene():
 
 # Given the scene and max photon depth (#hitting)
 # Return the photon map
-def trace_photons(depth, channel):
-    emission_intensity = 1000  # To be tuned
+# channel None builds one map for all channels, where each photon carries
+# an RGB power instead of being traced once per channel
+# num_workers > 1 splits the photons of each light across processes,
+# each traces a partial map whose photon columns are merged in order
+# at the end
+# seed makes the emission reproducible, the maps hold the same photons
+# for any num_workers
+# scene defaults to the current Blender scene, or can be a bvh.BVHScene
+# By default every light emits emission_intensity photons per unit of energy,
+# a num_photons budget is split across the lights by power instead, and each
+# photon carries the power of the default photons it stands for, so the map
+# has the same total power at any size
+def trace_photons(depth, channel=None, num_workers=1, seed=None, scene=None, num_photons=None):
+    global job_scene
+    import multiprocessing
+    emission_intensity = PHOTONS_PER_ENERGY
+
+    # fork is not available on every platform
+    if "fork" not in multiprocessing.get_all_start_methods():
+        num_workers = 1
 
     print("Start Building Photon Map!")
-    scene = bpy.context.scene
-    lights = [o for o in scene.objects if o.type == "LIGHT"]
+    if scene is None:
+        scene = bpy.context.scene
+    job_scene = scene  # read by the jobs, inherited by forked workers
+    # built once, inherited by forked workers
+    material_table(scene)
+    lights = light_table(scene)
+
+    # Determine #photons for each light source
+    if num_photons is None:
+        light_photons = (lights.power * emission_intensity).astype(np.int64)
+    else:
+        light_photons = split_photons(lights, num_photons)
+    print(f"Emit {light_photons.sum()} photons from {len(lights)} lights")
+
+    # All the jobs draw from one counter-based random stream,
+    # keyed by (photon index, light index, path, bounce)
+    key = stream_key(seed)
+
+    # and split them into one job per worker
+    jobs = []
+    flux = light_flux(lights)
+    for light_index, light in enumerate(lights):
+        # the RGB power of every photon of the light, the photons of a light
+        # carry emission_intensity times its flux
+        photon_power = flux[light_index] * emission_intensity / max(light_photons[light_index], 1)
+        first_photon = 0
+        for i in range(num_workers):
+            job_photons = light_photons[light_index] // num_workers + (i < light_photons[light_index] % num_workers)
+            if job_photons:
+                jobs.append([light_index, job_photons, depth, channel, key, photon_power, first_photon])
+            first_photon += job_photons
+
+    if num_workers > 1:
+        # fork so that workers inherit the scene
+        pool = multiprocessing.get_context("fork").Pool(num_workers)
+        partial_columns = pool.map(emit_photons_job, jobs)
+        pool.close()
+        pool.join()
+    else:
+        partial_columns = [emit_photons_job(job) for job in jobs]
 
     # Build photon map
     photon_map = PhotonMap()
     photon_map.depth = depth
+    photon_map.channel = -1 if channel is None else channel
+    for columns in partial_columns:
+        photon_map.add_photons(*columns)
 
-    # Determine #photons for each light source
-    for light in lights:
-        # Determine emission pattern from light property
-        if light.data.type == "AREA":
-            is_area_light = True
-            ratio = 0.5
-        else:
-            ratio = 1.0  # Can use ratio < 0.5 for spotlights
-            is_area_light = False
-
-        light_dir = np.array([0, 0, -1]) # Use any direction (TODO)
-        light_dir = normalize(light_dir)
-
-        for i in range(int(light.data.energy * emission_intensity)):
-            # Create a photon (original) from the emission pattern
-            photon = Photon()
-
-            light_loc = np.array(light.location)
-
-            # Sample the photon location if it is area light
-            if is_area_light:
-                radius = light.data.size / 2
-                light_loc += sample_disk_loc(1, light_dir, radius)[0]
-                light_loc += eps * light_dir
-            photon.set_loc(light_loc[0], light_loc[1], light_loc[2])
-
-
-            direction = sample_dirs(1, light_dir, 0.5)
-            photon.set_dir(direction[0][0], direction[0][1], direction[0][2])
-
-            # Trace the photon recursively
-            trace_photon(scene, depth, channel, photon, photon_map)
-            
     print("Finished Building Photon Map!")
     return photon_map
 
 
-# Trace one photon recursively
-# Add a copy of it to photon map each time it reflects
-def trace_photon(scene, depth, channel, photon, photon_map):
-    # Get photon location and direction
-    photon_loc = Vector(photon.location)
-    photon_dir = Vector(photon.direction)
+# Scene traced by the jobs of trace_photons()
+job_scene = None
 
-    # Find intersection using ray casting
-    has_hit, hit_loc, hit_norm, _, hit_obj, _ = ray_cast(scene, photon_loc, photon_dir)
 
-    if not has_hit:
-        return
+# Split a budget of num_photons photons across the lights in proportion to
+# their power, using the cdf of the light table
+# Stratified: light i gets round(num_photons * cdf[i]) - round(num_photons * cdf[i - 1])
+# photons, so the counts always sum to num_photons
+# Return the (#lights,) int array of #photons of each light
+def split_photons(lights, num_photons):
+    bounds = np.round(num_photons * np.concatenate(([0], lights.cdf))).astype(np.int64)
+    return np.diff(bounds)
 
-    # If hit, update depth, location of original photon
-    new_loc = hit_loc + hit_norm * eps
-    photon.set_loc(new_loc[0], new_loc[1], new_loc[2])
-    photon.depth = photon.depth + 1
 
-    # Add a copy of original photon to photon map if not direct illumination
-    if photon.depth > 0:
-        photon_copy = photon.copy()
-        photon_copy.id = photon_map.get_id()
-        photon_map.add_photon(photon_copy)
+# Emit the photons of one job of trace_photons()
+# job is [light index in light_table(), #photons, depth, channel,
+# random stream key, power of each photon, index of the first photon]
+# Return the columns (locations, directions, powers, depths) of the photons
+# of the job, plain arrays pickle across processes even after photonMap
+# is reloaded
+def emit_photons_job(job):
+    light_index, num_photons, depth, channel, key, photon_power, first_photon = job
 
-    # Determint whether the photon will be absorbed
-    # Or already diffused/reflected/transmissed enough of times
+    photon_map = PhotonMap()
+    light = light_table(job_scene)[light_index]
+    emit_photons(job_scene, light, num_photons, depth, channel, photon_map, photon_power,
+                 key=key, light_index=light_index, first_photon=first_photon)
+    n = photon_map.size
+    return (photon_map.locations[:n], photon_map.directions[:n],
+            photon_map.powers[:n], photon_map.depths[:n])
+
+
+# Return (n, num) uniform samples of the photons photon_ids of a light,
+# drawn from the counter-based stream of key at (photon id, light index,
+# path, bounce), or from np.random if key is None
+def photon_uniforms(key, photon_ids, light_index, paths, bounce, num):
+    if key is None:
+        return np.random.rand(len(photon_ids), num)
+    return counter_uniforms(key, photon_ids, light_index, paths, bounce, num)
+
+
+# Emit num_photons photons from a light and trace them into photon_map
+# light is a record of light_table(), every photon starts with the RGB
+# photon_power
+# Photons are emitted and traced batch_size at a time
+# With a random stream key, the photons are numbered from first_photon
+# in the stream of light_index
+def emit_photons(scene, light, num_photons, depth, channel, photon_map, photon_power=1.0,
+                 batch_size=10000, key=None, light_index=0, first_photon=0):
+    # Determine emission pattern from light property
+    # Other than area lights, lights shine all around, as in RT_shade_many()
+    ratio = 1.0  # Can use ratio < 0.5 for spotlights
+
+    light_dir = light.normal
+
+    for start in range(0, num_photons, batch_size):
+        n = min(batch_size, num_photons - start)
+        photon_ids = np.arange(first_photon + start, first_photon + start + n)
+        u = photon_uniforms(key, photon_ids, light_index, 0, 0, 4)
+
+        # Create the photons (original) from the emission pattern
+        locations = np.tile(light.location, (n, 1))
+
+        # Sample the photon location on the disk if it is area light
+        if light.is_area:
+            locations += sample_disk_loc(n, np.array([0., 0., 1.]), light.radius, u[:, 0:2]) @ light.frame.T
+            locations += eps * light_dir
+
+        # Area lights are diffuse emitters, their intensity falls off
+        # with the cosine to the light normal
+        if light.is_area:
+            directions, _ = sample_cosine_dirs(n, light_dir, u[:, 2:4])
+        else:
+            directions = sample_dirs(n, light_dir, ratio, u[:, 2:4])
+
+        # Trace the photons bounce by bounce
+        powers = np.full((n, 3), photon_power)
+        trace_photon_batch(scene, depth, channel, locations, directions, powers, photon_map,
+                           key, light_index, photon_ids)
+
+
+# Trace a batch of photons with a work queue instead of recursion
+# locations, directions, powers are (n, 3) arrays of the emitted photons
+# Every bounce casts all the queued photons, adds the hit photons to the map,
+# then queues the diffused/reflected/transmitted photons for the next bounce
+# With a random stream key, the decisions of photon_ids[i] are drawn at
+# (photon id, light_index, path, bounce), path numbers the spawned photons
+# of a photon, see branch_paths()
+def trace_photon_batch(scene, depth, channel, locations, directions, powers, photon_map,
+                       key=None, light_index=0, photon_ids=None):
     k_a = 0.1  # rate of abosorbtion, hard coded
-    if sample_bernoulli(k_a) or photon.depth >= depth:
-        return  # absorbed or max depth
-
-    # Get intersection material information
-    mat = hit_obj.simpleRT_material
-
-    # Update hit_norm and ray_inside_object
-    ray_inside_object = False
-    if hit_norm.dot(photon_dir) > 0:
-        hit_norm = -hit_norm
-        ray_inside_object = True
-
-    # Create a diffuse photon if the material is diffusive
-    # The diffusion of a channel
-    k_d = mat.diffuse_color[channel]
-    if sample_bernoulli(k_d):
-        photon_diffuse = photon.copy()
-        D_diffuse = sample_dirs(1, hit_norm, 0.5)[0]  # hemisphere sampling
-        photon_diffuse.direction = np.array(D_diffuse)  # Create a copy for diffusion
-        trace_photon(scene, depth, channel, photon_diffuse, photon_map)
-
-    # Reflection
-    # Determine k_r, rate of reflection, range [0, 1]
-    if mat.use_fresnel:
-        # calculate k_r using schlick’s approximation
-        R_0 = ((1 - mat.ior) / (1 + mat.ior)) ** 2
-        k_r = R_0 + (1 - R_0) * (1 + hit_norm.dot(photon_dir)) ** 5
-    else:
-        k_r = mat.mirror_reflectivity
-
-    if sample_bernoulli(k_r):
-        # reflection
-        D_reflect = photon_dir - 2 * photon_dir.dot(hit_norm) * hit_norm
-        photon.direction = np.array(D_reflect)
-
-        # Call recursively for reflection or transmission
-        trace_photon(scene, depth, channel, photon, photon_map)
-
-    # Determine transmission
-    if sample_bernoulli(mat.transmission):
-        # transmission
-        n1_by_n2 = 1 / mat.ior
-
-        if ray_inside_object:
-            n1_by_n2 = mat.ior
-
-        D_dot_N = photon_dir.dot(hit_norm)
-        inside_root = 1 - (n1_by_n2 ** 2) * (1 - D_dot_N ** 2)
-        if inside_root > 0:
-            D_transmiss = photon_dir * n1_by_n2 - hit_norm * (n1_by_n2 * D_dot_N + inside_root ** 0.5)
-            photon.direction = np.array(D_transmiss)
-
-        # Call recursively for reflection or transmission
-        trace_photon(scene, depth, channel, photon, photon_map)
+    depths = np.zeros(len(locations), dtype=np.int64)
+    if photon_ids is None:
+        photon_ids = np.arange(len(locations))
+    paths = np.zeros(len(locations), dtype=np.int64)
+
+    while len(locations):
+        # Find intersections using ray casting
+        has_hit, hit_locs, hit_norms, _, obj_indices = \
+            ray_cast_many(scene, locations, directions)
+
+        hit_locs = hit_locs[has_hit]
+        hit_norms = hit_norms[has_hit]
+        directions = directions[has_hit]
+        powers = powers[has_hit]
+        obj_indices = obj_indices[has_hit]
+        photon_ids = photon_ids[has_hit]
+        paths = paths[has_hit]
+
+        # If hit, update depth, location of the photons
+        # and add them to the photon map
+        depths = depths[has_hit] + 1
+        photon_map.add_photons(hit_locs + hit_norms * eps, directions, powers, depths)
+
+        # The absorption, diffusion, reflection, transmission decisions
+        # and the diffuse direction of every photon
+        u = photon_uniforms(key, photon_ids, light_index, paths, depths, 6)
+
+        # Determint whether the photons will be absorbed
+        # Or already diffused/reflected/transmissed enough of times
+        alive = ~sample_bernoulli(k_a, u[:, 0]) & (depths < depth)
+        hit_locs = hit_locs[alive]
+        hit_norms = hit_norms[alive]
+        directions = directions[alive]
+        powers = powers[alive]
+        depths = depths[alive]
+        obj_indices = obj_indices[alive]
+        photon_ids = photon_ids[alive]
+        paths = paths[alive]
+        u = u[alive]
+
+        # Get intersection material information from the material table
+        mats = material_arrays(scene, obj_indices)
+        diffuse_colors = mats["diffuse_color"]
+        iors = mats["ior"]
+        use_fresnel = mats["use_fresnel"]
+        mirror_reflectivity = mats["mirror_reflectivity"]
+        transmission = mats["transmission"]
+
+        # Update hit_norms and ray_inside_object
+        dots = np.einsum("ij,ij->i", hit_norms, directions)
+        ray_inside_object = dots > 0
+        hit_norms[ray_inside_object] *= -1
+        dots[ray_inside_object] *= -1
+
+        # Spawned photons start on the side of the surface they come from,
+        # transmitted photons on the other side
+        outside_locs = hit_locs + hit_norms * eps
+        inside_locs = hit_locs - hit_norms * eps
+
+        # Diffusion rate of a channel, or averaged over all channels
+        if channel is None:
+            k_d = diffuse_colors.mean(axis=1)
+        else:
+            k_d = diffuse_colors[:, channel]
+
+        # Reflection
+        # Determine k_r, rate of reflection, range [0, 1]
+        # calculate k_r using schlick’s approximation if use_fresnel
+        R_0 = ((1 - iors) / (1 + iors)) ** 2
+        k_r = np.where(use_fresnel, R_0 + (1 - R_0) * (1 + dots) ** 5, mirror_reflectivity)
+        D_reflect = directions - 2 * dots[:, None] * hit_norms
+
+        # Transmission, total internal reflection if there is no refraction
+        n1_by_n2 = np.where(ray_inside_object, iors, 1 / iors)
+        inside_root = 1 - (n1_by_n2 ** 2) * (1 - dots ** 2)
+        D_transmit = directions * n1_by_n2[:, None] - \
+            hit_norms * (n1_by_n2 * dots + np.sqrt(np.maximum(inside_root, 0)))[:, None]
+        D_transmit[inside_root <= 0] = D_reflect[inside_root <= 0]
+        transmit_locs = np.where((inside_root > 0)[:, None], inside_locs, outside_locs)
+
+        # Decide whether every photon is diffused, reflected and transmitted at once
+        diffused, reflected, transmitted = sample_bernoulli(
+            np.stack((k_d, k_r, transmission), axis=1), u[:, 1:4]).T
+
+        # Create diffuse photons if the material is diffusive
+        # Lambertian reflection, cosine-weighted around the normal
+        diffuse_dirs, _ = sample_cosine_dirs(np.count_nonzero(diffused), hit_norms[diffused], u[diffused, 4:6])
+        diffuse_powers = powers[diffused]
+        if channel is None:
+            # keep the expected power of every channel
+            diffuse_powers = diffuse_powers * diffuse_colors[diffused] / k_d[diffused, None]
+
+        # Queue the spawned photons for the next bounce
+        locations = np.concatenate((outside_locs[diffused], outside_locs[reflected], \
+            transmit_locs[transmitted]))
+        directions = np.concatenate((diffuse_dirs, D_reflect[reflected], D_transmit[transmitted]))
+        powers = np.concatenate((diffuse_powers, powers[reflected], powers[transmitted]))
+        depths = np.concatenate((depths[diffused], depths[reflected], depths[transmitted]))
+        photon_ids = np.concatenate((photon_ids[diffused], photon_ids[reflected], photon_ids[transmitted]))
+        branches = np.repeat([0, 1, 2], [np.count_nonzero(diffused), np.count_nonzero(reflected),
+                                         np.count_nonzero(transmitted)])
+        paths = branch_paths(photon_ids, np.concatenate((paths[diffused], paths[reflected],
+                                                         paths[transmitted])), branches)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,14 @@
 # The implementation of Photon and PhotonMap
-# PhotonMap is based on mathutils.kdtree.KDTree
+# PhotonMap is based on a spatial index from spatialIndex.py
+# mathutils.kdtree.KDTree is used inside Blender, scipy or numpy elsewhere
 # https://docs.blender.org/api/2.90/mathutils.kdtree.html
-# This script should be run from Blender render() method
-from mathutils.kdtree import KDTree
+import importlib
+import spatialIndex
+importlib.reload(spatialIndex)
+from spatialIndex import *
+
 import numpy as np
+import struct
 from random import random
 from time import time
 
@@ -14,6 +19,7 @@ class Photon():
         self.id = photon_id  # photon id, starting from 0
         self.location = None  # photon location
         self.direction = None  # photon direction
+        self.power = np.ones(3)  # photon RGB power
         self.depth = 0 # Set to n to represent it is the nth intersection
 
     def set_loc(self, x, y, z):
@@ -26,6 +32,7 @@ class Photon():
         copy = Photon()
         copy.location = self.location
         copy.direction = self.direction
+        copy.power = self.power
         copy.depth = self.depth
         return copy
 
@@ -38,97 +45,303 @@ class Photon():
             Direction: {self.direction[0]:.3f}, {self.direction[1]:.3f}, {self.direction[2]:.3f}.')
 
 
+# Binary photon map file, all values little-endian
+# Header of MAP_HEADER_SIZE bytes: magic, version, photon count,
+# channel, max depth, bounding box (min xyz, max xyz), zero padding
+# followed by the columns: locations float32 (count, 3),
+# directions float32 (count, 3), powers float32 (count, 3), depths uint8 (count)
+# Version 1 files have no powers column, their photons have unit power
+MAP_MAGIC = b"PMAP"
+MAP_VERSION = 2
+MAP_HEADER = struct.Struct("<4sIQiI6f")
+MAP_HEADER_SIZE = 64
+
+
+# Read the header of a binary map file as a dict
+# Return None if the file is not a binary map (e.g. a pickled map)
+def read_map_header(path):
+    file = open(path, "rb")
+    data = file.read(MAP_HEADER.size)
+    file.close()
+    if len(data) < MAP_HEADER.size or data[:4] != MAP_MAGIC:
+        return None
+
+    magic, version, count, channel, depth, *bbox = MAP_HEADER.unpack(data)
+    if version > MAP_VERSION:
+        raise ValueError(f'Photon map version {version} is newer than supported {MAP_VERSION}')
+    return {"version": version, "count": count, "channel": channel,
+        "depth": depth, "bbox": np.array(bbox, dtype=np.float32)}
+
+
+# Path of the spatial index saved together with a map file
+def index_path(map_path):
+    return map_path + ".index.npz"
+
+
 # The class for a photon map, size will never decrease
+# Photons are stored column by column (structure of arrays):
+# row i of each column holds the photon whose id is i
 class PhotonMap():
-    def __init__(self, map_path=None):
-        # HashTable to store all photons
-        # key is photon id
-        # value is the photon object corresponding to the id
+    def __init__(self, map_path=None, capacity=1024):
+        # Columns of the photon store, grown by doubling in _reserve()
+        # Only the first self.size rows are valid
+        self.size = 0
+        self.locations = np.zeros((capacity, 3), dtype=np.float32)
+        self.directions = np.zeros((capacity, 3), dtype=np.float32)
+        self.powers = np.zeros((capacity, 3), dtype=np.float32)
+        self.depths = np.zeros(capacity, dtype=np.uint8)
+
+        self.depth = 0 # max photon depth in the map
+        self.channel = -1 # color channel the map is built for, -1 for all channels
+
+        # Spatial index (KDTree) to store photon locations
+        self.index = None
+
         if (map_path):
-            import pickle
-            file = open(map_path, "rb")
-            self.map = pickle.load(file)
-            file.close()
-            print("Load photon map of size: ", len(self.map))
+            self.load_map(map_path)
+            print("Load photon map of size: ", self.size)
         else:
-            self.map = {}
             print("Init an empty photon map")
 
-        # KDTree to store photon locations
-        self.kdtree = None
-
-        self.depth = 0 # max photon depth in the map
-
-    # build the KDTree and balance it
+    def __len__(self):
+        return self.size
+
+    # make sure the columns can hold at least n photons
+    # capacity is doubled so that add_photon() is amortized O(1)
+    def _reserve(self, n):
+        capacity = len(self.depths)
+        if n <= capacity:
+            return
+        capacity = max(n, 2 * capacity)
+
+        locations = np.zeros((capacity, 3), dtype=np.float32)
+        directions = np.zeros((capacity, 3), dtype=np.float32)
+        powers = np.zeros((capacity, 3), dtype=np.float32)
+        depths = np.zeros(capacity, dtype=np.uint8)
+        locations[:self.size] = self.locations[:self.size]
+        directions[:self.size] = self.directions[:self.size]
+        powers[:self.size] = self.powers[:self.size]
+        depths[:self.size] = self.depths[:self.size]
+
+        self.locations = locations
+        self.directions = directions
+        self.powers = powers
+        self.depths = depths
+
+    # build the spatial index over photon locations
+    # backend is one of spatialIndex.BACKENDS, or None to choose at runtime
+    # options are passed to the index, e.g. workers for the scipy backend
+    # the index loaded with the map is reused if it matches backend and options
     # call it after finishing all add_photon()
-    def build_tree(self):
-        self.kdtree = KDTree(len(self.map))
-        for p in self.map.values():
-            self.kdtree.insert(p.location, p.id)
-        self.kdtree.balance()
-        print("Build tree of size: ", len(self.map))
+    def build_tree(self, backend=None, **options):
+        if self.index is not None and len(self.index) == self.size \
+            and self.index.matches(backend, **options):
+            print(f'Use saved {type(self.index).__name__} of size: ', self.size)
+            return
+
+        self.index = build_index(self.locations[:self.size], backend, **options)
+        print(f'Build {type(self.index).__name__} of size: ', self.size)
 
     # return an available id for a new photon
     def get_id(self):
-        return len(self.map)
+        return self.size
 
     # add each single photon to the map
+    # the photon is copied into row p.id of the columns
     # call build_tree() after all add_photon()
     def add_photon(self, p):
-        self.map[p.id] = p
+        self._reserve(p.id + 1)
+        self.locations[p.id] = p.location
+        self.directions[p.id] = p.direction
+        self.powers[p.id] = p.power
+        self.depths[p.id] = p.depth
+        self.size = max(self.size, p.id + 1)
+
+    # add n photons at once, given (n, 3) locations, directions, powers
+    # and (n,) depths; their ids are get_id() to get_id() + n - 1
+    # call build_tree() after all add_photons()
+    def add_photons(self, locations, directions, powers, depths):
+        n = self.size
+        self._reserve(n + len(depths))
+        self.locations[n:n + len(depths)] = locations
+        self.directions[n:n + len(depths)] = directions
+        self.powers[n:n + len(depths)] = powers
+        self.depths[n:n + len(depths)] = depths
+        self.size = n + len(depths)
+
+    # return a Photon object holding a copy of the photon with the given id
+    # for debug, use the columns directly in hot loops
+    def get_photon(self, photon_id):
+        p = Photon(photon_id)
+        p.location = np.array(self.locations[photon_id], dtype=np.float64)
+        p.direction = np.array(self.directions[photon_id], dtype=np.float64)
+        p.power = np.array(self.powers[photon_id], dtype=np.float64)
+        p.depth = int(self.depths[photon_id])
+        return p
 
     # find n nearest photons to a given location
     # return the photons' ids
     # need build_tree() before calling this function
     def find_photons_n(self, loc, n):
-        # built-in function returns a list of tuples: (location, id, distance)
-        results = self.kdtree.find_n(loc, n)
-        ids = []
-        for result in results:
-            ids.append((result[1], result[2]))  # id, distance
-        # print("Query results size: ", len(ids))
-        return ids
+        ids, distances = self.index.find_n(loc, n)
+        return list(zip(ids.tolist(), distances.tolist()))  # id, distance
 
     # find all photons within a radius of a given location
     # return the photons' ids
     # need build_tree() before calling this function
     def find_photons_r(self, loc, r):
-        results = self.kdtree.find_range(loc, r)
-        ids = []
-        for result in results:
-            ids.append((result[1], result[2]))
-        # print("Query results size: ", len(ids))
-        return ids
-
-    # save self.map to a file
+        ids, distances = self.index.find_range(loc, r)
+        return list(zip(ids.tolist(), distances.tolist()))
+
+    # find all photons within a radius of each location in an (N, 3) array
+    # return CSR-style arrays (offsets, ids, distances), the photons around
+    # locations[i] are ids[offsets[i]:offsets[i + 1]]
+    # need build_tree() before calling this function
+    def find_photons_r_batch(self, locations, r):
+        return self.index.find_range_batch(locations, r)
+
+    # estimate the RGB irradiance at each location of an (N, 3) array
+    # from the power of the photons within a radius r, per unit of area
+    # only the photons above the surface of normals[i] and coming towards it,
+    # which hit min_depth or more surfaces, are counted
+    # the map must be built for all channels
+    # locations are gathered chunk_size at a time, as dense regions can hold
+    # many photons around each location
+    # need build_tree() before calling this function
+    def irradiance_batch(self, locations, normals, r, min_depth=1, chunk_size=256):
+        if self.channel >= 0:
+            raise ValueError(f'Irradiance needs a map of all channels, not of channel {self.channel}')
+        irradiance = np.zeros((len(locations), 3))
+        for start in range(0, len(locations), chunk_size):
+            queries = locations[start:start + chunk_size]
+            offsets, ids, _ = self.find_photons_r_batch(queries, r)
+            loc_ids = np.repeat(np.arange(len(queries)), np.diff(offsets))
+
+            to_photon = self.locations[ids] - queries[loc_ids]
+            query_normals = normals[start:start + chunk_size][loc_ids]
+            above = np.einsum("ij,ij->i", to_photon, query_normals) >= 0
+            towards = np.einsum("ij,ij->i", self.directions[ids], query_normals) < 0
+            valid = above & towards & (self.depths[ids] >= min_depth)
+            loc_ids, ids = loc_ids[valid], ids[valid]
+
+            for c in range(3):
+                irradiance[start:start + chunk_size, c] = \
+                    np.bincount(loc_ids, weights=self.powers[ids, c], minlength=len(queries))
+        return irradiance / (np.pi * r ** 2)
+
+    # save the photon columns to a binary map file, see MAP_HEADER
     # for separate map building and rendering
-    def save_map(self, path):
+    # save_index also saves the built index next to it, see index_path()
+    # the file is written to a temporary file which then replaces path,
+    # so a map loaded from path (whose columns are memory-mapped) can be
+    # saved back to it, e.g. to add its index
+    def save_map(self, path, save_index=False):
+        import os
+        n = self.size
+        if n:
+            bbox = np.concatenate((self.locations[:n].min(axis=0), self.locations[:n].max(axis=0)))
+        else:
+            bbox = np.zeros(6, dtype=np.float32)
+
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(temp_path, "wb") as file:
+                file.write(MAP_HEADER.pack(MAP_MAGIC, MAP_VERSION, n, self.channel, self.depth, *bbox))
+                file.write(bytes(MAP_HEADER_SIZE - MAP_HEADER.size))
+                self.locations[:n].tofile(file)
+                self.directions[:n].tofile(file)
+                self.powers[:n].tofile(file)
+                self.depths[:n].tofile(file)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        # an index saved with the old map would not match the new one
+        if os.path.exists(index_path(path)):
+            os.remove(index_path(path))
+        if save_index:
+            self.save_index(path)
+
+    # save the built index next to the map file at map_path
+    # PhotonMap(map_path) loads it, so build_tree() can skip the build
+    def save_index(self, map_path):
+        if self.index is None:
+            return
+        if self.index.state:
+            self.index.save(index_path(map_path))
+        else:
+            print(f'Skip saving {type(self.index).__name__}, it can not be saved')
+
+    # load the photon columns saved by save_map()
+    # the columns are memory-mapped read-only, so loading is instant and
+    # processes rendering the same map share its pages
+    # adding photons to a loaded map copies the columns into memory first
+    # maps pickled as a dict of Photon objects are converted on load
+    def load_map(self, path):
+        header = read_map_header(path)
+        if header is None:
+            self.load_pickled_map(path)
+        elif header["count"]:
+            n = header["count"]
+            self.channel = header["channel"]
+            self.depth = header["depth"]
+            self.size = n
+
+            offset = MAP_HEADER_SIZE
+            self.locations = np.memmap(path, np.float32, "r", offset, (n, 3))
+            offset += self.locations.nbytes
+            self.directions = np.memmap(path, np.float32, "r", offset, (n, 3))
+            offset += self.directions.nbytes
+            if header["version"] >= 2:
+                self.powers = np.memmap(path, np.float32, "r", offset, (n, 3))
+                offset += self.powers.nbytes
+            else:
+                self.powers = np.ones((n, 3), dtype=np.float32)
+            self.depths = np.memmap(path, np.uint8, "r", offset, (n,))
+
+        # reuse the index saved with the map, build_tree() then skips the build
+        from os.path import exists
+        if exists(index_path(path)):
+            self.index = load_index(index_path(path), self.locations[:self.size])
+
+    # load a map pickled by older versions of save_map()
+    def load_pickled_map(self, path):
         import pickle
-        file = open(path, "wb")
-        pickle.dump(self.map, file)
+        file = open(path, "rb")
+        photons = pickle.load(file)
         file.close()
 
+        # key is photon id, value is the Photon object
+        n = len(photons)
+        self.size = 0
+        self._reserve(n)
+        self.size = n
+        for i in range(n):
+            self.locations[i] = photons[i].location
+            self.directions[i] = photons[i].direction
+            self.powers[i] = getattr(photons[i], "power", 1)
+            self.depths[i] = photons[i].depth
+        self.depth = int(self.depths[:n].max()) if n else 0
+
     # save all the photon locations
     # for debug and visualization
     def save_locations(self, path):
-        locations = np.zeros((len(self.map), 3))
-        for i in range(len(self.map)):
-            locations[i][:] = self.map[i].location
-        np.save(path, locations)
+        np.save(path, self.locations[:self.size])
 
     # check the correctness of photon map
     def check_correctness(self):
-        assert(self.map)
-        assert(self.kdtree)
+        assert(self.size)
+        assert(self.index)
 
         # each photon show match a location in KDTree
-        for photon_id in self.map.keys():
-            p = self.map[photon_id]
-            assert(photon_id == self.kdtree.find_n(p.location, 1)[0][1])
+        for photon_id in range(self.size):
+            assert(photon_id == self.find_photons_n(self.locations[photon_id], 1)[0][0])
         print("Check correctness success!")
 
 
-def profile(map_size, num_query, query_radius, dir_path=None):
+def profile(map_size, num_query, query_radius, dir_path=None, backend=None):
     map_size = int(map_size)
     num_query = int(num_query)
 
@@ -144,7 +357,7 @@ def profile(map_size, num_query, query_radius, dir_path=None):
 
     t1 = time()
 
-    photon_map.build_tree()
+    photon_map.build_tree(backend)
 
     t2 = time()
 
@@ -164,7 +377,7 @@ def profile(map_size, num_query, query_radius, dir_path=None):
 
     if (dir_path):
         from os.path import join
-        map_path = join(dir_path, "map.pkl")
+        map_path = join(dir_path, "map.bin")
         loc_path = join(dir_path, "locations.npy")
         photon_map.save_map(map_path)
         photon_map.save_locations(loc_path)
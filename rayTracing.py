@@ -4,6 +4,24 @@ import numpy as np
 from mathutils import Vector
 from math import sqrt
 
+import importlib
+import sys
+sys.path.append("./tools")
+
+import sample
+importlib.reload(sample)
+from sample import *
+
+# Dimensions of the random numbers of a bounce,
+# see counter_uniforms() and RT_trace_rays()
+DIM_CONTINUATION = 0  # 1 number, the continuation picked by path sampling
+DIM_HEMISPHERE = 1    # 2 numbers, the diffuse direction
+DIM_LIGHTS = 4        # 2 numbers per light, the emission point on the light
+
+# Dimensions of a camera sample used by the pixel jitter, the first bounce
+# follows, see sequence_uniforms()
+CAMERA_DIMS = 2
+
 def ray_cast(scene, origin, direction):
    """wrapper around Blender's Scene.ray_cast() API
 
@@ -35,9 +53,623 @@ def ray_cast(scene, origin, direction):
    return scene.ray_cast(scene.view_layers[0], origin, direction)
 
 
-def RT_trace_ray(scene, ray_orig, ray_dir, lights, depth=0):
+def ray_cast_many(scene, origins, directions):
+    """Cast a batch of rays, the array counterpart of ray_cast()
+
+    All callers that trace many rays go through this function, so the
+    per-ray Blender call can later be swapped for a faster engine
+
+    Parameters
+    ----------
+    scene : bpy.types.Scene or bvh.BVHScene
+        The scene we will cast the rays in
+    origins : numpy.ndarray, (N, 3) or (3,) floats
+        Origins of the rays, a single origin is shared by all the rays
+    directions : numpy.ndarray, (N, 3) floats
+        Directions of the rays
+
+    Returns
+    -------
+    has_hit : numpy.ndarray, (N,) bools
+        If each ray hits anything in the scene
+    hit_locs : numpy.ndarray, (N, 3) floats
+        The hit locations, zero for rays that miss
+    hit_norms : numpy.ndarray, (N, 3) floats
+        The face normals at the hit locations, zero for rays that miss
+    indices : numpy.ndarray, (N,) ints
+        The face indices of the hit faces, -1 for rays that miss
+    obj_indices : numpy.ndarray, (N,) ints
+        The indices of the hit objects in scene.objects, -1 for rays that miss
+    """
+    # scenes with their own batched ray casting, e.g. bvh.BVHScene
+    if hasattr(scene, "ray_cast_many"):
+        return scene.ray_cast_many(origins, directions)
+
+    directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+    origins = np.broadcast_to(np.asarray(origins, dtype=np.float64), directions.shape)
+    n = len(directions)
+
+    has_hit = np.zeros(n, dtype=bool)
+    hit_locs = np.zeros((n, 3))
+    hit_norms = np.zeros((n, 3))
+    indices = np.full(n, -1, dtype=np.int64)
+    obj_indices = np.full(n, -1, dtype=np.int64)
+
+    object_indices = {o.name: i for i, o in enumerate(scene.objects)}
+    for i in range(n):
+        hit, hit_loc, hit_norm, index, hit_obj, _ = \
+            ray_cast(scene, Vector(origins[i]), Vector(directions[i]))
+        if hit:
+            has_hit[i] = True
+            hit_locs[i] = hit_loc
+            hit_norms[i] = hit_norm
+            indices[i] = index
+            obj_indices[i] = object_indices[hit_obj.name]
+
+    return has_hit, hit_locs, hit_norms, indices, obj_indices
+
+
+def camera_ray_dirs(scene, width, height):
+    """Compute the normalized direction of the camera ray of every pixel
+
+    Parameters
+    ----------
+    scene : bpy.types.Scene
+        The scene with the active camera
+    width : int
+        Width of the rendered image
+    height : int
+        Height of the rendered image
+
+    Returns
+    -------
+    ray_dirs : numpy.ndarray, (height, width, 3) floats
+        ray_dirs[y, x] is the ray direction of pixel (x, y),
+        y starts from the bottom of the screen
+    """
+    focal_length = scene.camera.data.lens / scene.camera.data.sensor_width
+    aspect_ratio = height / width
+
+    # screen space coordinates of all the pixels
+    screen_y = ((np.arange(height) - (height / 2)) / height) * aspect_ratio
+    screen_x = (np.arange(width) - (width / 2)) / width
+
+    ray_dirs = np.zeros((height, width, 3))
+    ray_dirs[:, :, 0] = screen_x[None, :]
+    ray_dirs[:, :, 1] = screen_y[:, None]
+    ray_dirs[:, :, 2] = -focal_length
+
+    # rotate the directions by the camera orientation
+    rotation = np.array(scene.camera.rotation_euler.to_matrix())
+    ray_dirs = ray_dirs @ rotation.T
+    return ray_dirs / np.linalg.norm(ray_dirs, axis=2, keepdims=True)
+
+
+def reflect_dir(ray_dir, hit_norm):
+    """Mirror reflection of ray_dir about hit_norm"""
+    return ray_dir - 2 * ray_dir.dot(hit_norm) * hit_norm
+
+
+def transmit_dir(ray_dir, hit_norm, ior, ray_inside_object):
+    """Refraction of ray_dir through a surface with index of refraction ior
+
+    Returns
+    -------
+    D_transmit : Vector, float array of 3 items
+        The refracted direction, None on total internal reflection
+    """
+    n1_by_n2 = 1 / ior
+    if ray_inside_object:
+        n1_by_n2 = ior
+
+    D_dot_N = ray_dir.dot(hit_norm)
+    inside_root = 1 - (n1_by_n2 ** 2) * (1 - D_dot_N ** 2)
+    if inside_root <= 0:
+        return None
+    return ray_dir * n1_by_n2 - hit_norm * (n1_by_n2 * D_dot_N + inside_root ** 0.5)
+
+
+def diffuse_dir(hit_norm):
+    """Sample the direction of a diffuse bounce around hit_norm
+
+    Directions are cosine-weighted, the returned weight turns a sample into
+    an estimate of the uniform hemisphere estimator L * cos(theta), whose
+    expectation is the integral of L * cos(theta) / (2 pi)
+
+    Returns
+    -------
+    rand_dir_global : Vector, float array of 3 items
+        The sampled direction
+    weight : float
+        cos(theta) / (2 pi pdf), i.e. 1 / 2
+    """
+    # CKPT 3
+    # sample a direction from the hemisphere which points at hit_norm direction
+    rand_dirs, weights = diffuse_dirs(np.array([hit_norm]))
+    return Vector(rand_dirs[0]), weights[0]
+
+
+def diffuse_dirs(hit_norms, u=None):
+    """Sample the directions of diffuse bounces, the array counterpart of
+    diffuse_dir()
+
+    Parameters
+    ----------
+    hit_norms : numpy.ndarray, (N, 3) floats
+        Unit normals of the hemispheres
+    u : numpy.ndarray, (N, 2) floats
+        Uniform samples to use instead of drawing from np.random
+
+    Returns
+    -------
+    rand_dirs : numpy.ndarray, (N, 3) floats
+        The sampled directions
+    weights : numpy.ndarray, (N,) floats
+        cos(theta) / (2 pi pdf) of the directions
+    """
+    rand_dirs, pdfs = sample_cosine_dirs(len(hit_norms), hit_norms, u)
+    cos_theta = np.einsum("ij,ij->i", rand_dirs, hit_norms)
+    return rand_dirs, cos_theta / (2 * np.pi * np.maximum(pdfs, 1e-12))
+
+
+# The simpleRT_material of an object packed into a record
+MATERIAL_DTYPE = np.dtype([
+    ("diffuse_color", np.float64, 3),
+    ("specular_color", np.float64, 3),
+    ("specular_hardness", np.float64),
+    ("use_fresnel", np.bool_),
+    ("ior", np.float64),
+    ("mirror_reflectivity", np.float64),
+    ("transmission", np.float64),
+])
+
+# Cached material tables, scene key -> (table, object name -> index)
+material_tables = {}
+
+# A light of the scene in world space
+LIGHT_DTYPE = np.dtype([
+    ("object_index", np.int64),      # index in scene.objects
+    ("is_area", np.bool_),
+    ("location", np.float64, 3),
+    ("normal", np.float64, 3),       # emission direction of area lights
+    ("frame", np.float64, (3, 3)),   # maps the light's local disk to world space
+    ("radius", np.float64),
+    ("intensity", np.float64, 3),    # color * energy / (4 pi)
+    ("power", np.float64),
+    ("cdf", np.float64),             # for power-proportional light selection
+])
+
+# Cached light tables, scene key -> table
+light_tables = {}
+
+# Photons emitted per unit of light energy by trace_photons(), the photons
+# of a light carry PHOTONS_PER_ENERGY times its flux, see light_flux()
+PHOTONS_PER_ENERGY = 1000  # To be tuned
+
+
+def scene_key(scene):
+    """Key of a scene in material_tables, stable across Python wrappers"""
+    return scene.as_pointer() if hasattr(scene, "as_pointer") else id(scene)
+
+
+def material_table(scene):
+    """The simpleRT_material of every object of the scene as packed records
+
+    The table is built once and reused until invalidate_scene_tables()
+    drops it, so the tracers read materials by object index instead of through
+    Blender's property access at every hit
+
+    Parameters
+    ----------
+    scene : bpy.types.Scene or bvh.BVHScene
+        The scene whose materials are read
+
+    Returns
+    -------
+    table : numpy.recarray, (len(scene.objects),) MATERIAL_DTYPE
+        table[i] is the material of scene.objects[i],
+        zero for objects without a simpleRT_material
+    """
+    key = scene_key(scene)
+    if key in material_tables and len(material_tables[key][0]) == len(scene.objects):
+        return material_tables[key][0]
+
+    objects = list(scene.objects)
+    table = np.zeros(len(objects), dtype=MATERIAL_DTYPE).view(np.recarray)
+    for i, o in enumerate(objects):
+        mat = getattr(o, "simpleRT_material", None)
+        if mat is None:
+            continue
+        table[i] = (mat.diffuse_color[:3], mat.specular_color[:3], mat.specular_hardness,
+                    mat.use_fresnel, mat.ior, mat.mirror_reflectivity, mat.transmission)
+
+    material_tables[key] = (table, {o.name: i for i, o in enumerate(objects)})
+    return table
+
+
+def material_record(scene, obj):
+    """The packed material of one object, see material_table()"""
+    table = material_table(scene)
+    return table[material_tables[scene_key(scene)][1][obj.name]]
+
+
+def light_table(scene):
+    """The lights of the scene in world space, built once and reused until
+    invalidate_scene_tables() drops it
+
+    Parameters
+    ----------
+    scene : bpy.types.Scene or bvh.BVHScene
+        The scene whose lights are read
+
+    Returns
+    -------
+    table : numpy.recarray, (#lights,) LIGHT_DTYPE
+        One record per light, in the order of scene.objects
+    """
+    key = scene_key(scene)
+    if key in light_tables:
+        return light_tables[key]
+
+    lights = [(i, o) for i, o in enumerate(scene.objects) if o.type == "LIGHT"]
+    table = np.zeros(len(lights), dtype=LIGHT_DTYPE).view(np.recarray)
+    for record, (i, light) in zip(table, lights):
+        rotation = np.array(light.rotation_euler.to_matrix())
+        is_area = light.data.type == "AREA"
+        record.object_index = i
+        record.is_area = is_area
+        record.location = light.location[:]
+        record.normal = rotation @ (0, 0, -1)
+        record.frame = np.array(light.matrix_world)[:3, :3]
+        record.radius = light.data.size / 2 if is_area else 0
+        record.intensity = np.array(light.data.color[:3]) * light.data.energy / (4 * np.pi)
+        record.power = light.data.energy
+    if len(table) and table.power.sum() > 0:
+        table.cdf = np.cumsum(table.power) / table.power.sum()
+
+    light_tables[key] = table
+    return table
+
+
+def light_flux(lights):
+    """The RGB flux every light shines in RT_shade_many()
+
+    Area lights shine their intensity times the cosine to their normal over
+    their front, the other lights shine it all around. trace_photons() gives
+    the photons of a light PHOTONS_PER_ENERGY times this flux, so a photon
+    map converts to the flux of the lights with the same scale for all of
+    them
+
+    Parameters
+    ----------
+    lights : numpy.recarray
+        The lights of the scene, see light_table()
+
+    Returns
+    -------
+    flux : numpy.ndarray, (L, 3) floats
+        The flux of every light
+    """
+    return np.where(lights.is_area, np.pi, 4 * np.pi)[:, None] * lights.intensity
+
+
+def invalidate_scene_tables(scene=None, depsgraph=None):
+    """Drop the cached material and light tables of a scene, or of all scenes
+
+    Also registered as a depsgraph_update_post handler by simpleRT,
+    materials and lights are carried by objects, so only object updates
+    invalidate the tables
+    """
+    if depsgraph is not None and not depsgraph.id_type_updated("OBJECT"):
+        return
+    if scene is None:
+        material_tables.clear()
+        light_tables.clear()
+    else:
+        material_tables.pop(scene_key(scene), None)
+        light_tables.pop(scene_key(scene), None)
+
+
+def material_arrays(scene, obj_indices):
+    """The materials of the hit objects, one record per ray
+
+    Parameters
+    ----------
+    scene : bpy.types.Scene or bvh.BVHScene
+        The scene the rays were cast in
+    obj_indices : numpy.ndarray, (N,) ints
+        The indices of the hit objects in scene.objects
+
+    Returns
+    -------
+    mats : numpy.recarray, (N,) MATERIAL_DTYPE
+        mats["diffuse_color"] and mats["specular_color"] are (N, 3) floats,
+        the other fields (N,) arrays
+    """
+    return material_table(scene)[obj_indices]
+
+
+def RT_shade_many(scene, hit_locs, hit_norms, ray_dirs, mats, lights, u=None):
+    """Shade a batch of hit points, the wavefront counterpart of the shading
+    in RT_trace_ray()
+
+    Blinn-Phong shading, shadow rays and Fresnel reflectivity are evaluated
+    for every hit point and every light at once, the shadow rays of all the
+    lights are cast as a single batch
+
+    Parameters
+    ----------
+    scene : bpy.types.Scene or bvh.BVHScene
+        The scene the rays were cast in
+    hit_locs : numpy.ndarray, (N, 3) floats
+        The hit locations
+    hit_norms : numpy.ndarray, (N, 3) floats
+        The face normals at the hit locations, facing against ray_dirs
+    ray_dirs : numpy.ndarray, (N, 3) floats
+        Directions of the rays
+    mats : numpy.recarray
+        The materials of the hit objects, see material_arrays()
+    lights : numpy.recarray
+        The lights of the scene, see light_table()
+    u : numpy.ndarray, (N, 2 * #lights) floats
+        Uniform samples of the emission points to use instead of drawing
+        from np.random, columns 2l and 2l + 1 are used by light l
+
+    Returns
+    -------
+    colors : numpy.ndarray, (N, 3) floats
+        The direct lighting and ambient color of every hit point
+    k_r : numpy.ndarray, (N,) floats
+        The reflectivity of every hit point
+    """
+    eps = 0.0003
+    n, num_lights = len(hit_locs), len(lights)
+    colors = np.zeros((n, 3))
+    if n == 0:
+        return colors, np.zeros(0)
+
+    light_locs = lights.location
+
+    # CKPT 1
+    # area lights emit from a random point of their disk towards their front,
+    # other lights from their location, shape (L, N, ...)
+    if u is None:
+        u = np.random.rand(n, 2 * num_lights)
+    u = u.reshape(n, num_lights, 2).transpose(1, 0, 2)
+    r = np.sqrt(u[:, :, 0])
+    theta = 2 * np.pi * u[:, :, 1]
+    emit_locs_local = np.stack((r * np.cos(theta), r * np.sin(theta), np.zeros_like(r)), axis=2) \
+        * lights.radius[:, None, None]
+    emit_locs = np.einsum("lij,lnj->lni", lights.frame, emit_locs_local) + light_locs[:, None, :]
+
+    to_hit = hit_locs[None, :, :] - light_locs[:, None, :]
+    facing = np.einsum("lj,lnj->ln", lights.normal, to_hit) / \
+        np.maximum(np.linalg.norm(to_hit, axis=2), 1e-12)
+    intensities = lights.intensity[:, None, :] * \
+        np.where(lights.is_area[:, None], np.maximum(0, facing), 1)[:, :, None]
+
+    # the direction from hit location to the light
+    light_vecs = emit_locs - hit_locs[None, :, :]
+    light_dists2 = np.einsum("lnj,lnj->ln", light_vecs, light_vecs)
+    light_dirs = light_vecs / np.sqrt(light_dists2)[:, :, None]
+
+    # cast the shadow rays of all the lights at once
+    shadow_origs = np.broadcast_to(hit_locs + hit_norms * eps, light_dirs.shape)
+    has_light_hit, light_hit_locs, _, _, _ = ray_cast_many(
+        scene, shadow_origs.reshape(-1, 3), light_dirs.reshape(-1, 3))
+    has_light_hit = has_light_hit.reshape(num_lights, n)
+    light_to_hit = light_hit_locs.reshape(num_lights, n, 3) - emit_locs
+
+    # a light is blocked if the hit point is closer than the light
+    blocked = has_light_hit & (np.einsum("lnj,lnj->ln", light_vecs, light_to_hit) < 0)
+    visible = ~blocked
+
+    # shade with Blinn-Phong model
+    irradiance = intensities / light_dists2[:, :, None]
+    n_dot_l = np.einsum("lnj,nj->ln", light_dirs, hit_norms)
+    half_vectors = light_dirs - ray_dirs[None, :, :]
+    half_vectors /= np.linalg.norm(half_vectors, axis=2, keepdims=True)
+    n_dot_h = np.einsum("lnj,nj->ln", half_vectors, hit_norms)
+    with np.errstate(invalid="ignore"):
+        specular = np.power(n_dot_h, mats["specular_hardness"][None, :])
+    colors += mats["diffuse_color"] * np.where(visible[:, :, None], irradiance * n_dot_l[:, :, None], 0).sum(axis=0)
+    colors += mats["specular_color"] * np.where(visible[:, :, None], irradiance * specular[:, :, None], 0).sum(axis=0)
+
+    # if none of the lights hit the object, add the ambient component
+    no_light_hit = ~visible.any(axis=0)
+    colors[no_light_hit] += mats["diffuse_color"][no_light_hit] * np.array(scene.simpleRT.ambient_color[:3])
+
+    # calculate k_r using schlick’s approximation if use_fresnel
+    iors = mats["ior"]
+    R_0 = ((1 - iors) / (1 + iors)) ** 2
+    dots = np.einsum("ij,ij->i", hit_norms, ray_dirs)
+    k_r = np.where(mats["use_fresnel"], R_0 + (1 - R_0) * (1 + dots) ** 5, mats["mirror_reflectivity"])
+
+    return colors, k_r
+
+
+def RT_trace_rays(scene, ray_origs, ray_dirs, lights, depth=0, path_sampling=False,
+                  key=None, ray_ids=None, samples=None, sampler="random",
+                  photon_map=None, gather_radius=0.25):
+    """Trace a batch of rays, the wavefront counterpart of RT_trace_ray()
+
+    The rays of every bounce are cast and shaded as one batch, the spawned
+    reflection, transmission and diffuse rays are queued for the next bounce
+    with the weight of their contribution to the color of their camera ray
+
+    With a key, every random number is drawn from the counter-based stream
+    of the key at (ray id, sample, path, bounce), where path numbers the
+    branches of a camera ray (see branch_paths()), so the colors do not
+    depend on how the rays are batched. A "sobol" or "halton" sampler draws them from the
+    low-discrepancy sequence of (ray id, path) instead, bounce after bounce
+    from dimension CAMERA_DIMS
+
+    With a photon_map, the diffuse rays only do a final gather: where a
+    ray hits after a diffuse bounce, the indirect light is estimated from
+    the photons around the hit instead of spawning more diffuse rays
+
+    Parameters
+    ----------
+    scene : bpy.types.Scene or bvh.BVHScene
+        The scene that will be rendered
+    ray_origs : numpy.ndarray, (N, 3) or (3,) floats
+        Origins of the rays, a single origin is shared by all the rays
+    ray_dirs : numpy.ndarray, (N, 3) floats
+        Directions of the rays
+    lights : numpy.recarray
+        The lights of the scene, see light_table()
+    depth: int
+        The number that light bounces in the scene
+    path_sampling : bool
+        Follow one continuation per bounce, see RT_trace_ray()
+    key : numpy.ndarray, 2 uint32
+        Key of the random stream, see stream_key(), np.random is used if None
+    ray_ids : numpy.ndarray, (N,) ints
+        Ids of the rays in the stream, e.g. pixel indices
+    samples : numpy.ndarray, (N,) ints
+        Sample numbers of the rays in the stream
+    sampler : str
+        "random", "sobol" or "halton", see sequence_uniforms()
+    photon_map : PhotonMap
+        A map of all the channels traced by trace_photons(), with an index
+        built for range queries of gather_radius, see PhotonMap.irradiance_batch()
+    gather_radius : float
+        The radius of the photons gathered around a hit
+
+    Returns
+    -------
+    colors : numpy.ndarray, (N, 3) floats
+        Color of every ray
+    """
+    eps = 0.0003
+    directions = np.asarray(ray_dirs, dtype=np.float64).reshape(-1, 3)
+    origins = np.broadcast_to(np.asarray(ray_origs, dtype=np.float64), directions.shape)
+    colors = np.zeros((len(directions), 3))
+
+    # the camera ray, the branch and the weight of every ray in flight
+    pixels = np.arange(len(directions))
+    paths = np.zeros(len(directions), dtype=np.int64)
+    weights = np.ones((len(directions), 3))
+    # whether the ray is a final gather ray, spawned by a diffuse bounce
+    gathering = np.zeros(len(directions), dtype=bool)
+
+    # uniform samples of the rays in flight at the current bounce
+    def uniforms(num, offset):
+        if key is None:
+            return np.random.rand(len(pixels), num)
+        if sampler == "random":
+            return counter_uniforms(key, ray_ids[pixels], samples[pixels], paths, bounce, num, offset)
+        first_dim = CAMERA_DIMS + bounce * (DIM_LIGHTS + 2 * len(lights)) + offset
+        return sequence_uniforms(sampler, key, ray_ids[pixels], samples[pixels], paths, first_dim, num)
+
+    for bounce in range(depth + 1):
+        if not len(pixels):
+            break
+
+        has_hit, hit_locs, hit_norms, _, obj_indices = ray_cast_many(scene, origins, directions)
+        hit_locs = hit_locs[has_hit]
+        hit_norms = hit_norms[has_hit]
+        directions = directions[has_hit]
+        obj_indices = obj_indices[has_hit]
+        pixels = pixels[has_hit]
+        paths = paths[has_hit]
+        weights = weights[has_hit]
+        gathering = gathering[has_hit]
+
+        dots = np.einsum("ij,ij->i", hit_norms, directions)
+        ray_inside_object = dots > 0
+        hit_norms[ray_inside_object] *= -1
+        dots[ray_inside_object] *= -1
+
+        mats = material_arrays(scene, obj_indices)
+        shaded, k_r = RT_shade_many(scene, hit_locs, hit_norms, directions, mats, lights,
+                                    uniforms(2 * len(lights), DIM_LIGHTS))
+        np.add.at(colors, pixels, weights * shaded)
+
+        # the photons that hit more than one surface carry the indirect light
+        # the diffuse rays of the gather hits would bring, these estimate the
+        # integral of L * cos(theta) / (2 pi), i.e. half the irradiance
+        if gathering.any():
+            indirect = photon_map.irradiance_batch(hit_locs[gathering], hit_norms[gathering],
+                                                   gather_radius, min_depth=2) / PHOTONS_PER_ENERGY
+            np.add.at(colors, pixels[gathering],
+                      weights[gathering] * mats["diffuse_color"][gathering] * indirect / 2)
+
+        if bounce == depth:
+            break
+
+        # reflection
+        D_reflect = directions - 2 * dots[:, None] * hit_norms
+
+        # transmission, none on total internal reflection
+        iors = mats["ior"]
+        n1_by_n2 = np.where(ray_inside_object, iors, 1 / iors)
+        inside_root = 1 - (n1_by_n2 ** 2) * (1 - dots ** 2)
+        refracted = inside_root > 0
+        D_transmit = directions * n1_by_n2[:, None] - \
+            hit_norms * (n1_by_n2 * dots + np.sqrt(np.maximum(inside_root, 0)))[:, None]
+
+        # diffuse
+        D_diffuse, diffuse_weights = diffuse_dirs(hit_norms, uniforms(2, DIM_HEMISPHERE))
+
+        # weights of the continuations
+        w_reflect = k_r[:, None] * np.ones(3)
+        w_transmit = (np.where(refracted, (1 - k_r) * mats["transmission"], 0))[:, None] * np.ones(3)
+        w_diffuse = diffuse_weights[:, None] * mats["diffuse_color"]
+
+        if path_sampling:
+            # pick a continuation with probability p / scale,
+            # the path ends with probability 1 - p_total / scale
+            p_reflect = k_r
+            p_transmit = w_transmit[:, 0]
+            p_diffuse = np.where(gathering, 0, mats["diffuse_color"].mean(axis=1))
+            p_total = p_reflect + p_transmit + p_diffuse
+            scale = np.maximum(1, p_total)
+            choices = sample_choice(np.stack((p_reflect, p_transmit, p_diffuse), axis=1) / scale[:, None],
+                                    uniforms(1, DIM_CONTINUATION)[:, 0])
+            reflected, transmitted, diffused = choices == 0, choices == 1, choices == 2
+
+            w_reflect = scale[:, None] * np.ones(3)
+            w_transmit = scale[:, None] * np.ones(3)
+            w_diffuse = w_diffuse * (scale / np.where(diffused, p_diffuse, 1))[:, None]
+        else:
+            # follow every continuation that contributes
+            reflected = k_r > 0
+            transmitted = w_transmit[:, 0] > 0
+            diffused = mats["diffuse_color"].any(axis=1) & ~gathering
+
+        # queue the spawned rays for the next bounce
+        outside_locs = hit_locs + hit_norms * eps
+        inside_locs = hit_locs - hit_norms * eps
+        origins = np.concatenate((outside_locs[reflected], inside_locs[transmitted], outside_locs[diffused]))
+        directions = np.concatenate((D_reflect[reflected], D_transmit[transmitted], D_diffuse[diffused]))
+        pixels = np.concatenate((pixels[reflected], pixels[transmitted], pixels[diffused]))
+        if path_sampling:
+            paths = np.concatenate((paths[reflected], paths[transmitted], paths[diffused]))
+        else:
+            branches = np.repeat([0, 1, 2], [np.count_nonzero(reflected), np.count_nonzero(transmitted),
+                                             np.count_nonzero(diffused)])
+            paths = branch_paths(pixels, np.concatenate((paths[reflected], paths[transmitted],
+                                                         paths[diffused])), branches)
+        weights = np.concatenate((weights[reflected] * w_reflect[reflected],
+                                  weights[transmitted] * w_transmit[transmitted],
+                                  weights[diffused] * w_diffuse[diffused]))
+        gathering = np.concatenate((gathering[reflected], gathering[transmitted],
+                                    np.full(np.count_nonzero(diffused), photon_map is not None)))
+
+    return colors
+
+
+def RT_trace_ray(scene, ray_orig, ray_dir, lights, depth=0, path_sampling=False):
     """Cast a single ray into the scene
 
+    By default every hit spawns a reflection, a transmission and a diffuse
+    ray, so the cost grows exponentially with depth. With path_sampling,
+    a single continuation is followed, chosen with probability proportional
+    to its weight, and the path is terminated with Russian roulette when
+    the weights sum to less than 1. The expected color is the same, the
+    cost grows linearly with depth
+
     Parameters
     ----------
     scene : bpy.types.Scene
@@ -47,11 +679,13 @@ def RT_trace_ray(scene, ray_orig, ray_dir, lights, depth=0):
         Origin of the current ray
     ray_dir : Vector, float array of 3 items
         Direction of the current ray
-    lights : list of bpy_types.Object
-        The list of lights in the scene
+    lights : numpy.recarray
+        The lights of the scene, see light_table()
     depth: int
         The recursion depth of raytracing
         i.e. the number that light bounces in the scene
+    path_sampling : bool
+        Follow one continuation per bounce instead of all of them
 
     Returns
     -------
@@ -75,7 +709,7 @@ def RT_trace_ray(scene, ray_orig, ray_dir, lights, depth=0):
         ray_inside_object = True
 
     ambient_color = scene.simpleRT.ambient_color
-    mat = hit_obj.simpleRT_material
+    mat = material_record(scene, hit_obj)
     diffuse_color = Vector(mat.diffuse_color).xyz
     specular_color = Vector(mat.specular_color).xyz
     specular_hardness = mat.specular_hardness
@@ -83,19 +717,19 @@ def RT_trace_ray(scene, ray_orig, ray_dir, lights, depth=0):
     no_light_hit = True # true if none of the lights hits the location
 
     for light in lights:
-        light_color = np.array(light.data.color * light.data.energy / (4 * np.pi))
-        
-        if light.data.type == "AREA":
+        light_color = light.intensity
+        emit_loc_global = Vector(light.location)
+
+        if light.is_area:
             # CKPT 1
-            light_normal = Vector((0, 0, -1))
-            light_normal.rotate(light.rotation_euler)
+            light_normal = Vector(light.normal)
 
-            light_color =  light_color * max(0, light_normal.dot((hit_loc - light.location).normalized()))
+            light_color =  light_color * max(0, light_normal.dot((hit_loc - emit_loc_global).normalized()))
 
             r = sqrt(np.random.rand())
             theta = 2 * np.pi * np.random.rand()
-            emit_loc_local = Vector((r * np.cos(theta), r * np.sin(theta), 0)) * light.data.size / 2
-            emit_loc_global = light.matrix_world @ emit_loc_local
+            emit_loc_local = np.array((r * np.cos(theta), r * np.sin(theta), 0)) * light.radius
+            emit_loc_global += Vector(light.frame @ emit_loc_local)
 
         # the direction from hit location to the light
         light_vec = emit_loc_global - hit_loc
@@ -136,44 +770,41 @@ def RT_trace_ray(scene, ray_orig, ray_dir, lights, depth=0):
         k_r = mat.mirror_reflectivity
 
     # recursion
-    if depth > 0:
+    if depth > 0 and path_sampling:
+        D_transmit = transmit_dir(ray_dir, hit_norm, mat.ior, ray_inside_object)
+
+        # weights of the reflection, transmission and diffuse continuations
+        w_reflect = k_r
+        w_transmit = 0 if D_transmit is None else (1 - k_r) * mat.transmission
+        rand_dir, diffuse_weight = diffuse_dir(hit_norm)
+        w_diffuse = np.mean(diffuse_color)
+        w_total = w_reflect + w_transmit + w_diffuse
+
+        # pick a continuation with probability w / scale, the path ends
+        # with probability 1 - w_total / scale
+        scale = max(1, w_total)
+        u = np.random.rand() * scale
+        if u < w_reflect:
+            color += scale * RT_trace_ray(scene, hit_loc + hit_norm * eps, reflect_dir(ray_dir, hit_norm), lights, depth - 1, True)
+        elif u < w_reflect + w_transmit:
+            color += scale * RT_trace_ray(scene, hit_loc - hit_norm * eps, D_transmit, lights, depth - 1, True)
+        elif u < w_total:
+            color += scale / w_diffuse * RT_trace_ray(scene, hit_loc + hit_norm * eps, rand_dir, lights, depth - 1, True) * diffuse_weight * diffuse_color
+
+    elif depth > 0:
         # reflection
-        D_reflect = ray_dir - 2 * ray_dir.dot(hit_norm) * hit_norm
+        D_reflect = reflect_dir(ray_dir, hit_norm)
         color += k_r * RT_trace_ray(scene, hit_loc + hit_norm * eps, D_reflect, lights, depth - 1)
 
         # transmission
-        n1_by_n2 = 1 / mat.ior
-        if ray_inside_object:
-            n1_by_n2 = mat.ior
-
-        D_dot_N = ray_dir.dot(hit_norm)
-        inside_root = 1 - (n1_by_n2 ** 2) * (1 - D_dot_N ** 2)
-        if inside_root > 0:
-            D_transmit = ray_dir * n1_by_n2 - hit_norm * (n1_by_n2 * D_dot_N + inside_root ** 0.5)
+        D_transmit = transmit_dir(ray_dir, hit_norm, mat.ior, ray_inside_object)
+        if D_transmit is not None:
             color += (1 - k_r) * mat.transmission * RT_trace_ray(scene, hit_loc - hit_norm * eps, D_transmit, lights, depth - 1)
 
-        # CKPT 3
-        # set hit_norm to be z axis and find x and y axis
-        x_axis =  Vector((0, 0, 1))
-
-        if np.abs(hit_norm.dot(x_axis)) > 0.9:
-            x_axis = Vector((0, 1, 0))
-
-        x_axis -= x_axis.dot(hit_norm) * hit_norm
-        x_axis = x_axis.normalized()
-        y_axis = np.cross(x_axis, hit_norm)
-        y_axis = Vector((y_axis[0], y_axis[1], y_axis[2]))
-
-        # sample a direction from the hemisphere which points at hit_norm direction
-        cos_theta = np.random.rand()
-        sin_theta = sqrt(1 - cos_theta * cos_theta)
-        phi = 2 * np.pi * np.random.rand()
-        rand_dir_local = Vector((sin_theta * np.cos(phi), sin_theta * np.sin(phi), cos_theta))
-
-        # calculate global direction
-        rand_dir_global = x_axis * rand_dir_local[0] + y_axis * rand_dir_local[1] + hit_norm * rand_dir_local[2]
+        # diffuse
+        rand_dir_global, diffuse_weight = diffuse_dir(hit_norm)
 
         # calculate the contribution
-        color += RT_trace_ray(scene, hit_loc + hit_norm * eps, rand_dir_global, lights, depth - 1) * cos_theta * diffuse_color
+        color += RT_trace_ray(scene, hit_loc + hit_norm * eps, rand_dir_global, lights, depth - 1) * diffuse_weight * diffuse_color
 
     return color
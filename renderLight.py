@@ -1,4 +1,7 @@
-import bpy
+try:
+    import bpy
+except ImportError:  # headless, render a bvh.BVHScene
+    bpy = None
 
 import sys
 sys.path.append("./tools")
@@ -18,63 +21,44 @@ import numpy as np
 
 
 # TODO: support any light direction
-def trace_light(scene, light_loc, radius, intensity, cam_location, ray_dir):
-    # Get hit location
-    has_hit, hit_loc, hit_norm, _, hit_obj, _ = ray_cast(scene, cam_location, ray_dir)
+# ray_dirs is an (N, 3) array, return the (N, 3) light color of each ray
+def trace_light(scene, light_loc, radius, intensity, cam_location, ray_dirs):
+    # Get hit locations
+    has_hit, hit_locs, _, _, obj_indices = ray_cast_many(scene, np.array(cam_location), ray_dirs)
 
-    res = np.zeros(3)
+    res = np.zeros((len(ray_dirs), 3))
 
-    if has_hit and hit_obj.name == 'walls':
-        dist = np.dot(light_loc - hit_loc, light_loc - hit_loc)
-        dist = np.sqrt(dist)
-        if (dist <= radius):
-            res = intensity
+    names = np.array([o.name for o in scene.objects] + [None])
+    on_walls = has_hit & (names[obj_indices] == 'walls')
+    dist = np.linalg.norm(np.array(light_loc) - hit_locs, axis=1)
+    res[on_walls & (dist <= radius)] = intensity
 
     return res
 
-def render_light(npy_path):
-    scene = bpy.context.scene
+# scene defaults to the current Blender scene, or can be a bvh.BVHScene
+def render_light(npy_path, scene=None):
+    if scene is None:
+        scene = bpy.context.scene
     scale = scene.render.resolution_percentage / 100.0
-    objs = scene.objects
 
     # Compute camera parameters
     height = int(scene.render.resolution_x * scale)
     width = int(scene.render.resolution_y * scale)
 
-    buf = np.zeros((height, width, 3))
-
-    cam_location = scene.camera.location
-    cam_orientation = scene.camera.rotation_euler
-
-    focal_length = scene.camera.data.lens / scene.camera.data.sensor_width
-    aspect_ratio = height / width
-
-    # iterate through all the pixels, cast a ray for each pixel
-    for y in range(height):
-        print(f'Render progress: {(y + 1): d} /{height: d}')
-        # get screen space coordinate for y
-        screen_y = ((y - (height / 2)) / height) * aspect_ratio
-        for x in range(width):
-            # get screen space coordinate for x
-            screen_x = (x - (width / 2)) / width
-
-            # calculate the ray direction
-            ray_dir = Vector((screen_x, screen_y, -focal_length))
-            ray_dir.rotate(cam_orientation)
-            ray_dir = ray_dir.normalized()
-
-
-            # get light location and direction (TODO: support multiple lights)
-            area_lights = [o for o in scene.objects if \
-                            (o.type == "LIGHT" and o.data.type == "AREA")]
-            light = area_lights[0]
-            light_loc = light.location
-            light_radius = light.data.size / 2
-            light_intensity = np.array(light.data.color * light.data.energy / (4 * np.pi))
-
-            # trace all rays to see if it intersects with light
-            buf[height - 1 - y, x] = trace_light(scene, light_loc, light_radius,\
-                                                light_intensity, cam_location, ray_dir)
+    # get light location and direction (TODO: support multiple lights)
+    lights = light_table(scene)
+    light = lights[lights.is_area][0]
+    light_loc = light.location
+    light_radius = light.radius
+    light_intensity = light.intensity
+
+    # trace all rays to see if it intersects with light
+    # need to flip y, since screen origin starts from left bottom
+    # while image origin starts from left top
+    ray_dirs = camera_ray_dirs(scene, width, height)[::-1]
+    buf = trace_light(scene, light_loc, light_radius, light_intensity, \
+                      scene.camera.location, ray_dirs.reshape(-1, 3))
+    buf = buf.reshape(height, width, 3)
 
     buf = gaussian(buf, sigma=0.1, multichannel=True)  # smooth the light
 
@@ -1,5 +1,8 @@
 # Render a photon map
-import bpy
+try:
+    import bpy
+except ImportError:  # headless, render a bvh.BVHScene
+    bpy = None
 import sys
 sys.path.append("./tools")
 
@@ -20,15 +23,28 @@ import sample
 importlib.reload(sample)
 from sample import *
 
-# Render a single channel photon map to an image
-def render_map(map_path, npy_path, channel):
-    scene = bpy.context.scene
+# Render a photon map to an image
+# channel None renders the channel the map is built for,
+# or all channels if the map is built for all channels
+# scene defaults to the current Blender scene, or can be a bvh.BVHScene
+def render_map(map_path, npy_path, channel=None, scene=None):
+    if scene is None:
+        scene = bpy.context.scene
     scale = scene.render.resolution_percentage / 100.0
-    objs = scene.objects
 
-    photon_map = PhotonMap(map_path)
-    photon_map.build_tree()
     radius = 0.25 # TODO: tune the retrieval radius
+    photon_map = PhotonMap(map_path)
+    saved = photon_map.index is not None and photon_map.index.matches("grid", cell_size=radius)
+    photon_map.build_tree("grid", cell_size=radius)  # fixed-radius gathers only
+    if not saved:
+        # later renders of this map skip the build, if the map directory is writable
+        try:
+            photon_map.save_index(map_path)
+        except OSError as error:
+            print(f'Skip saving the index of {map_path}: {error}')
+
+    if channel is None and photon_map.channel >= 0:
+        channel = photon_map.channel
 
     # Compute camera parameters
     height = int(scene.render.resolution_x * scale)
@@ -36,31 +52,27 @@ def render_map(map_path, npy_path, channel):
 
     buf = np.zeros((height, width, 3))
 
-    cam_location = scene.camera.location
-    cam_orientation = scene.camera.rotation_euler
-
-    focal_length = scene.camera.data.lens / scene.camera.data.sensor_width
-    aspect_ratio = height / width
-
-    # iterate through all the pixels, cast a ray for each pixel
-    for y in range(height):
-        print(f'Render progress: {(y + 1): d} /{height: d}')
-        # get screen space coordinate for y
-        screen_y = ((y - (height / 2)) / height) * aspect_ratio
-        for x in range(width):
-            # get screen space coordinate for x
-            screen_x = (x - (width / 2)) / width
-
-            # calculate the ray direction
-            ray_dir = Vector((screen_x, screen_y, -focal_length))
-            ray_dir.rotate(cam_orientation)
-            ray_dir = ray_dir.normalized()
-
-            # trace global illumination corresponding to that pixel
-            # need to flip y, since screen origin starts from left bottom
-            # while image origin starts from left top
-            buf[height - 1 - y, x, channel] = \
-                trace_diffuse(scene, channel, cam_location, ray_dir, photon_map, radius)
+    # cast a ray for each pixel
+    # need to flip y, since screen origin starts from left bottom
+    # while image origin starts from left top
+    ray_dirs = camera_ray_dirs(scene, width, height)[::-1]
+    has_hit, hit_locs, hit_norms, _, obj_indices = \
+        ray_cast_many(scene, np.array(scene.camera.location), ray_dirs.reshape(-1, 3))
+    has_hit = has_hit.reshape(height, width)
+    hit_locs = hit_locs.reshape(height, width, 3)
+    hit_norms = hit_norms.reshape(height, width, 3)
+    obj_indices = obj_indices.reshape(height, width)
+
+    # diffuse color of the hit object of each pixel
+    hit_diffuse = material_table(scene)["diffuse_color"][obj_indices]
+
+    # gather global illumination for all the hit pixels at once
+    color = gather_diffuse(photon_map, hit_locs[has_hit], \
+        hit_norms[has_hit], hit_diffuse[has_hit], radius)
+    if channel is None:
+        buf[has_hit] = color
+    else:
+        buf[has_hit, channel] = color[:, channel]
 
     buf = gaussian(buf, sigma=0.5, multichannel=True)  # smooth the photon rendering
 
@@ -68,8 +80,6 @@ def render_map(map_path, npy_path, channel):
 
 
 def trace_diffuse(scene, channel, cam_location, ray_dir, photon_map, radius):
-    eps = 0.0003
-
     # Get hit location
     has_hit, hit_loc, hit_norm, _, hit_obj, _ = ray_cast(scene, cam_location, ray_dir)
 
@@ -78,21 +88,38 @@ def trace_diffuse(scene, channel, cam_location, ray_dir, photon_map, radius):
     if not has_hit:
         return color
 
-    # Retrieve the nearby photons
-    hit_loc = np.array(hit_loc)
-    photon_ids = photon_map.find_photons_r(hit_loc, radius)
-    
+    diffuse = material_record(scene, hit_obj).diffuse_color
+    return gather_diffuse(photon_map, np.array([hit_loc]), np.array([hit_norm]), \
+        np.array([diffuse]), radius)[0, channel]
+
+
+# Estimate the illumination at N hit locations from the nearby photons
+# hit_locs, hit_norms, diffuse (RGB diffuse color) are (N, 3) arrays
+# Return the (N, 3) RGB illumination
+def gather_diffuse(photon_map, hit_locs, hit_norms, diffuse, radius):
+    # Retrieve the nearby photons of every hit location
+    offsets, photon_ids, distances = photon_map.find_photons_r_batch(hit_locs, radius)
+
+    # The hit location each retrieved photon belongs to
+    hit_ids = np.repeat(np.arange(len(hit_locs)), np.diff(offsets))
+    norms = hit_norms[hit_ids]
+
+    # Only consider the photon is above hit surface
+    # and is coming towards the hit surface
+    hit_to_photon = photon_map.locations[photon_ids] - hit_locs[hit_ids]
+    dots = np.einsum("ij,ij->i", norms, photon_map.directions[photon_ids])
+    above = np.einsum("ij,ij->i", hit_to_photon, norms) >= 0
+    valid = above & (dots < 0)
+
     # Compute the illumination from the photons
-    for photon_id, distance in photon_ids:
-        p = photon_map.map[photon_id]
-
-        # Only consider the photon is above hit surface
-        hit_to_photon = p.location - hit_loc
-        if np.dot(hit_to_photon, hit_norm) >= 0:
-            dot = np.dot(hit_norm, p.direction)
-            if (dot < 0):
-                color += -dot * \
-                        hit_obj.simpleRT_material.diffuse_color[channel] / (0.05 + distance) ** 2
+    hit_ids = hit_ids[valid]
+    photon_ids = photon_ids[valid]
+    weights = -dots[valid] / (0.05 + distances[valid]) ** 2
+    weights = weights[:, None] * diffuse[hit_ids] * photon_map.powers[photon_ids]
+
+    color = np.zeros((len(hit_locs), 3))
+    for c in range(3):
+        color[:, c] = np.bincount(hit_ids, weights=weights[:, c], minlength=len(hit_locs))
     return color
 
 
@@ -1,5 +1,10 @@
 # The baseline implemented in HW3 and HW5
-import bpy
+try:
+    import bpy
+    RenderEngine = bpy.types.RenderEngine
+except ImportError:  # headless, RT_render_scene() renders a bvh.BVHScene
+    bpy = None
+    RenderEngine = object
 
 import importlib
 import photonMap
@@ -10,13 +15,42 @@ import rayTracing
 importlib.reload(rayTracing)
 from rayTracing import *
 
+if bpy:
+    # drop the cached material and light tables when objects change,
+    # replacing the handler of a previous import
+    handlers = bpy.app.handlers.depsgraph_update_post
+    for handler in [h for h in handlers if h.__name__ == "invalidate_scene_tables"]:
+        handlers.remove(handler)
+    handlers.append(invalidate_scene_tables)
 
-def RT_render_scene(scene, width, height, depth, num_sample, buf):
+
+def RT_render_scene(scene, width, height, depth, num_sample, buf,
+                    num_workers=1, tile_size=32, on_tile=None, seed=None,
+                    progressive=False, on_pass=None, test_break=None,
+                    noise_threshold=0, min_samples=4, sample_counts=None,
+                    path_sampling=False, sampler="random", photon_map=None,
+                    gather_radius=0.25):
     """Main function for rendering the scene
 
+    The frame is split into tiles of tile_size * tile_size pixels, which
+    are rendered by num_workers processes into a shared buffer, the rays
+    of all the pixels of a tile are traced together by RT_trace_rays()
+
+    In progressive mode the whole frame is rendered one sample at a time,
+    buf always holds the mean of the finished passes, so the render can
+    be stopped after any pass with a usable result
+
+    With a noise_threshold, sampling is adaptive: after min_samples
+    samples, a pixel keeps receiving one sample per pass only while the
+    standard error of its mean (tracked with Welford's algorithm) is above
+    noise_threshold times its brightness, up to num_sample samples
+
+    With a photon_map, the indirect light is gathered from the photons
+    where the first diffuse rays of a camera ray hit, see RT_trace_rays()
+
     Parameters
     ----------
-    scene : bpy.types.Scene
+    scene : bpy.types.Scene or bvh.BVHScene
         The scene that will be rendered
         It stores information about the camera, lights, objects, and material
     width : int
@@ -26,17 +60,199 @@ def RT_render_scene(scene, width, height, depth, num_sample, buf):
     depth : int
         The recursion depth of raytracing
         i.e. the number that light bounces in the scene
+    num_sample : int
+        The number of samples of each pixel, the maximum if adaptive
     buf: numpy.ndarray
         the buffer that will be populated to store the calculated color
         for each pixel
+    num_workers : int
+        The number of rendering processes, forked so that they inherit
+        the scene; tiles are rendered in this process if it is 1
+    tile_size : int
+        Width and height of a tile in pixels
+    on_tile : function
+        Called as on_tile(x0, y0, x1, y1) once the pixels
+        buf[y0:y1, x0:x1] of a tile are updated
+    seed : int
+        Makes the render reproducible, the random numbers are keyed by
+        pixel, sample, path and bounce, so the result does not depend on
+        num_workers, tile_size or the passes
+    progressive : bool
+        Render num_sample passes of one sample per pixel
+    on_pass : function
+        Called as on_pass(n) once buf holds the mean of up to n samples
+    test_break : function
+        Checked before every pass, the render stops when it returns True
+    noise_threshold : float
+        Relative noise level of adaptive sampling, 0 disables it
+    min_samples : int
+        The number of samples of every pixel before it can stop sampling
+    sample_counts : numpy.ndarray
+        (height, width) ints, populated with the number of samples
+        of each pixel if given
+    path_sampling : bool
+        Follow one continuation per bounce, see RT_trace_ray()
+    sampler : str
+        "random" jitters the pixels with the van der Corput sequence and
+        draws the rest from random streams, "sobol" and "halton" take all
+        the samples of a pixel from a low-discrepancy sequence
+    photon_map : PhotonMap
+        The photon map of the scene, e.g. loaded from a map file of
+        trace_photons() with channel None, its photons that hit more than
+        one surface are gathered, the indirect light is traced with rays
+        if None
+    gather_radius : float
+        The radius of the photons gathered around a hit
+
+    Returns
+    -------
+    buf : numpy.ndarray
+        The populated buffer
+    """
+    global tile_context
+    import multiprocessing
+
+    # fork is not available on every platform
+    if "fork" not in multiprocessing.get_all_start_methods():
+        num_workers = 1
+
+    # every tile as (x0, y0, x1, y1)
+    tiles = [(x0, y0, min(x0 + tile_size, width), min(y0 + tile_size, height))
+             for y0 in range(0, height, tile_size) for x0 in range(0, width, tile_size)]
+
+    # the number of samples of every pass
+    adaptive = noise_threshold > 0
+    min_samples = max(2, min(min_samples, num_sample))
+    if adaptive:
+        passes = [min_samples] + [1] * (num_sample - min_samples)
+    elif progressive:
+        passes = [1] * num_sample
+    else:
+        passes = [num_sample]
+
+    # read by the tile jobs, inherited by forked workers
+    # counts and m2 are the per-pixel sample counts and Welford sums of
+    # squared differences from the mean
+    tile_context = {
+        "scene": scene, "width": width, "height": height, "depth": depth,
+        "num_sample": num_sample, "key": stream_key(seed), "buf": buf,
+        "counts": np.zeros((height, width), dtype=np.int64),
+        "m2": np.zeros((height, width, 3)) if adaptive else None,
+        "noise_threshold": noise_threshold, "min_samples": min_samples,
+        "path_sampling": path_sampling, "sampler": sampler,
+        "photon_map": photon_map, "gather_radius": gather_radius,
+    }
+
+    # built once, inherited by forked workers
+    material_table(scene)
+    light_table(scene)
+    if photon_map is not None:
+        if photon_map.channel >= 0:
+            raise ValueError(f'Final gather needs a photon map of all channels, '
+                             f'the map is built for channel {photon_map.channel}')
+        # fixed-radius gathers only, reuses a saved grid of the same cell size
+        photon_map.build_tree("grid", cell_size=gather_radius)
+
+    pool = None
+    if num_workers > 1:
+        # workers write the tiles into buffers shared with this process
+        import ctypes
+        shared = multiprocessing.RawArray(ctypes.c_double, height * width * 4)
+        tile_context["buf"] = np.frombuffer(shared).reshape(height, width, 4)
+        shared = multiprocessing.RawArray(ctypes.c_int64, height * width)
+        tile_context["counts"] = np.frombuffer(shared, dtype=np.int64).reshape(height, width)
+        if adaptive:
+            shared = multiprocessing.RawArray(ctypes.c_double, height * width * 3)
+            tile_context["m2"] = np.frombuffer(shared).reshape(height, width, 3)
+        pool = multiprocessing.get_context("fork").Pool(num_workers)
+
+    total_samples = 0
+    for pass_samples in passes:
+        if test_break and test_break():
+            break
+
+        jobs = [(tile, pass_samples) for tile in tiles]
+        if pool:
+            finished = pool.imap_unordered(render_tile_job, jobs)
+        else:
+            finished = map(render_tile_job, jobs)
+
+        pass_traced = 0
+        for x0, y0, x1, y1, traced in finished:
+            pass_traced += traced
+            if pool:
+                buf[y0:y1, x0:x1] = tile_context["buf"][y0:y1, x0:x1]
+            if on_tile:
+                on_tile(x0, y0, x1, y1)
+
+        if pass_traced == 0:
+            break  # every pixel has converged
+        total_samples += pass_samples
+        if on_pass:
+            on_pass(total_samples)
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    if sample_counts is not None:
+        sample_counts[:] = tile_context["counts"]
+    return buf
+
+
+# Scene, settings and per-pixel state of the tiles rendered by RT_render_scene()
+tile_context = None
+
+
+def render_tile_job(job):
+    """Render one pass of one tile of RT_render_scene()
+
+    Parameters
+    ----------
+    job : tuple
+        ((x0, y0, x1, y1), #samples),
+        the tile covers the pixels buf[y0:y1, x0:x1]
+
+    Returns
+    -------
+    tile : tuple
+        (x0, y0, x1, y1, #traced samples) of the rendered tile
     """
+    (x0, y0, x1, y1), pass_samples = job
+    traced = render_tile(tile_context, x0, y0, x1, y1, pass_samples)
+    return x0, y0, x1, y1, traced
+
+
+def render_tile(context, x0, y0, x1, y1, pass_samples):
+    """Add pass_samples samples to each active pixel of buf[y0:y1, x0:x1]
+
+    Parameters
+    ----------
+    context : dict
+        The scene, settings and per-pixel state, see RT_render_scene()
+    x0, y0, x1, y1 : int
+        The tile covers the pixels buf[y0:y1, x0:x1]
+    pass_samples : int
+        The number of samples to add to each active pixel
+
+    Returns
+    -------
+    traced : int
+        The number of samples traced
+    """
+    scene = context["scene"]
+    width, height = context["width"], context["height"]
+    depth, num_sample = context["depth"], context["num_sample"]
+    buf, counts, m2 = context["buf"], context["counts"], context["m2"]
+    noise_threshold, min_samples = context["noise_threshold"], context["min_samples"]
+    path_sampling, sampler = context["path_sampling"], context["sampler"]
 
     # get all the lights from the scene
-    scene_lights = [o for o in scene.objects if o.type == "LIGHT"]
+    scene_lights = light_table(scene)
 
     # get the location and orientation of the active camera
-    cam_location = scene.camera.location
-    cam_orientation = scene.camera.rotation_euler
+    cam_location = np.array(scene.camera.location)
+    cam_rotation = np.array(scene.camera.rotation_euler.to_matrix())
 
     # get camera focal length
     focal_length = scene.camera.data.lens / scene.camera.data.sensor_width
@@ -45,33 +261,67 @@ def RT_render_scene(scene, width, height, depth, num_sample, buf):
     # CKPT 2.2
     dx = 1 / width
     dy = aspect_ratio / height
-    corput_x = [corput(i, 2) * dx for i in range(num_sample)]
-    corput_y = [corput(i, 3) * dy for i in range(num_sample)]
-    
+    corput_x = np.array([corput(i, 2) * dx for i in range(num_sample)])
+    corput_y = np.array([corput(i, 3) * dy for i in range(num_sample)])
+
+    # the pixels of the tile
+    tile_buf = buf[y0:y1, x0:x1]
+    tile_counts = counts[y0:y1, x0:x1]
+
+    # populate the alpha component of the buffer
+    # to make the pixel not transparent
+    tile_buf[:, :, 3] = 1
+
+    # skip the pixels once their mean is accurate enough
+    active = tile_counts < num_sample
+    if m2 is not None:
+        tile_m2 = m2[y0:y1, x0:x1]
+        sampled = np.maximum(tile_counts, 2)
+        error = np.sqrt(tile_m2.mean(axis=2) / (sampled * (sampled - 1)))
+        converged = (tile_counts >= min_samples) & \
+            (error <= noise_threshold * np.maximum(tile_buf[:, :, 0:3].mean(axis=2), 1e-3))
+        active &= ~converged
+
+    traced = 0
     # CKPT 2.1
-    # iterate through all the pixels, cast a ray for each pixel
-    for y in range(height):
-        # get screen space coordinate for y
-        screen_y = ((y - (height / 2)) / height) * aspect_ratio
-        for x in range(width):
-            # get screen space coordinate for x
-            screen_x = (x - (width / 2)) / width
-            
-            # populate the alpha component of the buffer
-            # to make the pixel not transparent
-            buf[y, x, 3] = 1
-            
-            for n in range(num_sample):
-                # calculate the ray direction
-                ray_dir = Vector((screen_x + corput_x[n], screen_y + corput_y[n], -focal_length))
-                ray_dir.rotate(cam_orientation)
-                ray_dir = ray_dir.normalized()
-                
-                # populate the RGB component of the buffer with ray tracing result
-                buf[y, x, 0:3] += RT_trace_ray(scene, cam_location, ray_dir, scene_lights, depth) 
-
-    buf[:, :, 0:3] /= num_sample
-    return buf
+    # cast one ray for every active pixel of the tile at a time
+    for _ in range(pass_samples):
+        active &= tile_counts < num_sample
+        ys, xs = np.nonzero(active)
+        if not len(ys):
+            break
+        n = tile_counts[ys, xs]
+        pixel_ids = (y0 + ys) * width + (x0 + xs)
+
+        # get screen space coordinates, jittered by the pixel's sample number
+        if sampler == "random":
+            jitter_x, jitter_y = corput_x[n], corput_y[n]
+        else:
+            jitter = sequence_uniforms(sampler, context["key"], pixel_ids, n, 0, 0, CAMERA_DIMS)
+            # centered on the pixel like corput()
+            jitter_x, jitter_y = (jitter[:, 0] - 0.5) * dx, (jitter[:, 1] - 0.5) * dy
+        ray_dirs = np.empty((len(n), 3))
+        ray_dirs[:, 0] = (x0 + xs - (width / 2)) / width + jitter_x
+        ray_dirs[:, 1] = ((y0 + ys - (height / 2)) / height) * aspect_ratio + jitter_y
+        ray_dirs[:, 2] = -focal_length
+
+        # calculate the ray directions
+        ray_dirs = ray_dirs @ cam_rotation.T
+        ray_dirs /= np.linalg.norm(ray_dirs, axis=1, keepdims=True)
+
+        # update the running mean of the RGB component of the buffer
+        # with ray tracing result
+        colors = RT_trace_rays(scene, cam_location, ray_dirs, scene_lights, depth, path_sampling,
+                               context["key"], pixel_ids, n, sampler,
+                               context["photon_map"], context["gather_radius"])
+        delta = colors - tile_buf[ys, xs, 0:3]
+        tile_buf[ys, xs, 0:3] += delta / (n + 1)[:, None]
+        if m2 is not None:
+            tile_m2[ys, xs] += delta * (colors - tile_buf[ys, xs, 0:3])
+        tile_counts[ys, xs] = n + 1
+        traced += len(n)
+
+    return traced
 
 # CKPT 2.2
 def corput(n, base):
@@ -83,7 +333,7 @@ def corput(n, base):
     return q - 0.5
 
 # modified from https://docs.blender.org/api/current/bpy.types.RenderEngine.html
-class SimpleRTRenderEngine(bpy.types.RenderEngine):
+class SimpleRTRenderEngine(RenderEngine):
     # These three members are used by blender to set up the RenderEngine
     # define its internal name, visible name and capabilities.
     bl_idname = "simple_RT"
@@ -121,7 +371,7 @@ class SimpleRTRenderEngine(bpy.types.RenderEngine):
         # profile(map_size=1e5, num_query=10, query_radius=0.2, dir_path=dir_path)
 
         # from os.path import join
-        # map_path = join(dir_path, "map.pkl")
+        # map_path = join(dir_path, "map.bin")
         # test_load_map(map_path)
         # #============== for project debug
 
@@ -132,19 +382,140 @@ class SimpleRTRenderEngine(bpy.types.RenderEngine):
         height, width = self.size_y, self.size_x
         buf = np.zeros((height, width, 4))
 
-        result = self.begin_result(0, 0, self.size_x, self.size_y)
-        layer = result.layers[0].passes["Combined"]
-
         # get the maximum ray tracing recursion depth
         depth = scene.simpleRT.recursion_depth
 
-        RT_render_scene(scene, width, height, depth, self.samples, buf)
-        
-        self.update_result(result)
-        layer.rect = buf.reshape(-1, 4).tolist()
+        # read the materials and lights once for this frame
+        invalidate_scene_tables(scene)
+
+        # settings of the engine, see SimpleRTEngineSettings
+        settings = scene.simpleRT_engine
+
+        # number of rendering processes
+        num_workers = settings.num_workers
+
+        # progressive rendering stops at test_break() or after time_limit seconds
+        from time import time
+        progressive = settings.progressive
+        time_limit = settings.time_limit
+        start_time = time()
+
+        def test_break():
+            return self.test_break() or (time_limit > 0 and time() - start_time > time_limit)
+
+        # show the whole frame after every progressive pass
+        def update_pass(n):
+            result = self.begin_result(0, 0, width, height)
+            layer = result.layers[0].passes["Combined"]
+            layer.rect = buf.reshape(-1, 4).tolist()
+            self.end_result(result)
+            self.update_stats("", f'Sample {n}/{self.samples}')
+
+        # show every tile as soon as it is finished
+        def update_tile(x0, y0, x1, y1):
+            result = self.begin_result(x0, y0, x1 - x0, y1 - y0)
+            layer = result.layers[0].passes["Combined"]
+            layer.rect = buf[y0:y1, x0:x1].reshape(-1, 4).tolist()
+            self.update_result(result)
+
+            # tell Blender all pixels of the tile have been set and are final
+            self.end_result(result)
+
+        # adaptive sampling stops sampling a pixel below noise_threshold
+        noise_threshold = settings.noise_threshold
+        # path sampling traces one ray per bounce instead of three
+        path_sampling = settings.path_sampling
+        # "random", "sobol" or "halton" samples
+        sampler = settings.sampler
+        # a photon map file replaces the diffuse rays after the first bounce
+        # with a gather of its photons
+        photon_map = None
+        photon_map_path = settings.photon_map_path
+        gather_radius = settings.gather_radius
+        if photon_map_path:
+            photon_map = PhotonMap(bpy.path.abspath(photon_map_path))
+        sample_counts = np.zeros((height, width), dtype=np.int64)
+
+        RT_render_scene(scene, width, height, depth, self.samples, buf,
+                        num_workers=num_workers, on_tile=update_tile,
+                        progressive=progressive, on_pass=update_pass if progressive else None,
+                        test_break=test_break, noise_threshold=noise_threshold,
+                        sample_counts=sample_counts, path_sampling=path_sampling,
+                        sampler=sampler, photon_map=photon_map, gather_radius=gather_radius)
+        self.sample_counts = sample_counts
+        print(f'Samples per pixel: mean {sample_counts.mean():.2f}, max {sample_counts.max()}')
+
+
+if bpy:
+    # Settings of the engine besides the samples, depth and ambient color
+    # of scene.simpleRT, stored in scene.simpleRT_engine
+    class SimpleRTEngineSettings(bpy.types.PropertyGroup):
+        num_workers: bpy.props.IntProperty(default=1, min=1, soft_max=64,
+            description="Number of rendering processes, forked from Blender")
+        progressive: bpy.props.BoolProperty(default=False,
+            description="Render the whole frame one sample per pixel at a time")
+        time_limit: bpy.props.FloatProperty(default=0.0, min=0.0,
+            description="Stop rendering after the pass that exceeds this many seconds, 0 for no limit")
+        noise_threshold: bpy.props.FloatProperty(default=0.0, min=0.0, soft_max=1.0,
+            description="Stop sampling a pixel once its relative noise is below this, 0 samples every pixel fully")
+        path_sampling: bpy.props.BoolProperty(default=False,
+            description="Follow one reflection, transmission or diffuse ray per bounce instead of all of them")
+        sampler: bpy.props.EnumProperty(default="random", items=[
+            ("random", "Random", "Van der Corput pixel jitter, random streams for the rest"),
+            ("sobol", "Sobol", "Owen-scrambled Sobol sequence"),
+            ("halton", "Halton", "Halton sequence with permuted digits"),
+        ], description="Where the samples of a pixel are drawn from")
+        photon_map_path: bpy.props.StringProperty(default="", subtype="FILE_PATH",
+            description="Binary photon map of all channels to gather the indirect light from, none traces it with rays")
+        gather_radius: bpy.props.FloatProperty(default=0.25, min=0.0, soft_max=1.0,
+            description="Radius of the photons gathered around a hit")
+
+    # SimpleRT engine panel, below the SimpleRT render settings
+    class SimpleRTEnginePanel(bpy.types.Panel):
+        bl_label = "SimpleRT Engine Settings"
+        bl_idname = "RENDER_PT_simpleRT_engine"
+        bl_space_type = "PROPERTIES"
+        bl_region_type = "WINDOW"
+        bl_context = "render"
+
+        @classmethod
+        def poll(cls, context):
+            return context.scene.render.engine == "simple_RT"
+
+        def draw(self, context):
+            sc = context.scene.simpleRT_engine
+            split = self.layout.split(factor=0.4)
+            col_1 = split.column()
+            col_2 = split.column()
+            col_1.alignment = "RIGHT"
+            col_1.label(text="workers")
+            col_2.prop(sc, "num_workers", text="")
+            col_1.label(text="progressive")
+            col_2.prop(sc, "progressive", text="")
+            col_1.label(text="time limit")
+            col_2.prop(sc, "time_limit", text="")
+            col_1.label(text="noise threshold")
+            col_2.prop(sc, "noise_threshold", text="")
+            col_1.label(text="path sampling")
+            col_2.prop(sc, "path_sampling", text="")
+            col_1.label(text="sampler")
+            col_2.prop(sc, "sampler", text="")
+            col_1.label(text="photon map")
+            col_2.prop(sc, "photon_map_path", text="")
+            col_1.label(text="gather radius")
+            row = col_2.row()
+            row.prop(sc, "gather_radius", text="")
+            row.active = bool(sc.photon_map_path)
 
-        # tell Blender all pixels have been set and are final
-        self.end_result(result)
+    # register the settings and the panel, replacing those of a previous import
+    if hasattr(bpy.types.Scene, "simpleRT_engine"):
+        del bpy.types.Scene.simpleRT_engine
+    for cls in (SimpleRTEngineSettings, SimpleRTEnginePanel):
+        registered = getattr(bpy.types, getattr(cls, "bl_idname", cls.__name__), None)
+        if registered is not None:
+            bpy.utils.unregister_class(registered)
+        bpy.utils.register_class(cls)
+    bpy.types.Scene.simpleRT_engine = bpy.props.PointerProperty(type=SimpleRTEngineSettings)
 
 if __name__ == "__main__":
     pass
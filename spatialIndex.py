@@ -0,0 +1,464 @@
+# Spatial indices over photon locations, used by PhotonMap.build_tree()
+# Every index is built from an (N, 3) array of locations
+# and refers to a location by its row number in that array
+# mathutils: mathutils.kdtree.KDTree, only available inside Blender
+# scipy: scipy.spatial.cKDTree, supports parallel queries with workers
+# numpy: pure NumPy k-d tree, available everywhere
+# grid: uniform grid for fixed-radius queries, available everywhere
+import numpy as np
+
+
+# Base class of all the spatial indices
+# find_n() and find_range() return (ids, distances) arrays
+# options are the arguments the index is built with
+class SpatialIndex():
+    backend = None  # name of the backend in BACKENDS
+    state = []  # attributes describing the built index, empty if it can't be saved
+
+    def __init__(self, locations, **options):
+        self.locations = locations
+        self.options = options
+
+    def __len__(self):
+        return len(self.locations)
+
+    # find n nearest locations, sorted by distance
+    def find_n(self, loc, n):
+        raise NotImplementedError
+
+    # find all locations within a radius of loc
+    def find_range(self, loc, r):
+        raise NotImplementedError
+
+    # find all locations within a radius of each location in an (N, 3) array
+    # return CSR-style arrays (offsets, ids, distances), the results of
+    # locations[i] are ids[offsets[i]:offsets[i + 1]]
+    def find_range_batch(self, locations, r):
+        locations = np.asarray(locations, dtype=np.float64).reshape(-1, 3)
+        offsets = np.zeros(len(locations) + 1, dtype=np.int64)
+        ids = []
+        distances = []
+        for i in range(len(locations)):
+            result_ids, result_distances = self.find_range(locations[i], r)
+            offsets[i + 1] = offsets[i] + len(result_ids)
+            ids.append(result_ids)
+            distances.append(result_distances)
+        return offsets, concat_ids(ids), concat_distances(distances)
+
+    # whether this index was built with the backend and options
+    # backend None matches any backend
+    def matches(self, backend, **options):
+        if backend is not None and backend != self.backend:
+            return False
+        return all(self.options.get(key) == value for key, value in options.items())
+
+    # save the built index to an .npz file, load it with load_index()
+    # the file is written to a temporary file which then replaces path,
+    # so processes loading path never see a partly written index
+    def save(self, path):
+        import os
+        if not self.state:
+            raise ValueError(f'{type(self).__name__} can not be saved')
+        arrays = {name: getattr(self, name) for name in self.state}
+        for key, value in self.options.items():
+            arrays["option_" + key] = value
+
+        temp_path = f'{path}.{os.getpid()}.tmp.npz'
+        try:
+            np.savez(temp_path, backend=self.backend, count=len(self), **arrays)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+# Wrapper of Blender's mathutils.kdtree.KDTree
+# https://docs.blender.org/api/2.90/mathutils.kdtree.html
+class MathutilsKDTree(SpatialIndex):
+    backend = "mathutils"
+
+    def __init__(self, locations):
+        from mathutils.kdtree import KDTree
+        super().__init__(locations)
+        self.kdtree = KDTree(len(locations))
+        for i in range(len(locations)):
+            self.kdtree.insert(locations[i], i)
+        self.kdtree.balance()
+
+    def find_n(self, loc, n):
+        # built-in function returns a list of tuples: (location, id, distance)
+        return self._to_arrays(self.kdtree.find_n(loc, n))
+
+    def find_range(self, loc, r):
+        return self._to_arrays(self.kdtree.find_range(loc, r))
+
+    def _to_arrays(self, results):
+        ids = np.array([result[1] for result in results], dtype=np.int64)
+        distances = np.array([result[2] for result in results], dtype=np.float64)
+        return ids, distances
+
+
+# Wrapper of scipy.spatial.cKDTree
+# workers is the number of processes for batch queries, -1 uses all the cores
+class ScipyKDTree(SpatialIndex):
+    backend = "scipy"
+
+    def __init__(self, locations, workers=-1):
+        from scipy.spatial import cKDTree
+        super().__init__(locations, workers=workers)
+        self.kdtree = cKDTree(np.asarray(locations, dtype=np.float64))
+        self.workers = workers
+
+    def find_n(self, loc, n):
+        n = min(n, len(self))
+        if n == 0:
+            return concat_ids([]), concat_distances([])
+        distances, ids = self.kdtree.query(loc, k=[i + 1 for i in range(n)])
+        return ids.astype(np.int64), distances
+
+    def find_range(self, loc, r):
+        ids = np.array(self.kdtree.query_ball_point(loc, r), dtype=np.int64)
+        return ids, self._distances(np.asarray(loc, dtype=np.float64), ids)
+
+    def find_range_batch(self, locations, r):
+        locations = np.asarray(locations, dtype=np.float64).reshape(-1, 3)
+        results = self.kdtree.query_ball_point(locations, r, workers=self.workers)
+
+        offsets = np.zeros(len(locations) + 1, dtype=np.int64)
+        np.cumsum([len(result) for result in results], out=offsets[1:])
+        ids = concat_ids([np.array(result, dtype=np.int64) for result in results])
+
+        query_ids = np.repeat(np.arange(len(locations)), np.diff(offsets))
+        return offsets, ids, self._distances(locations[query_ids], ids)
+
+    def _distances(self, locations, ids):
+        diff = self.kdtree.data[ids] - locations
+        return np.sqrt(np.einsum("ij,ij->i", diff, diff))
+
+
+# Pure NumPy k-d tree, the fallback when neither Blender nor SciPy is available
+# The tree is balanced by median splits along the widest axis
+# self.order is the permutation of locations such that every node owns
+# the contiguous range order[start:end]; a node is a leaf when left == -1
+class NumpyKDTree(SpatialIndex):
+    backend = "numpy"
+    state = ["order", "starts", "ends", "dims", "splits", "lefts", "rights"]
+
+    def __init__(self, locations, leaf_size=16):
+        super().__init__(locations, leaf_size=leaf_size)
+        n = len(locations)
+        self.order = np.arange(n, dtype=np.int64)
+
+        starts, ends, dims, splits, lefts, rights = [0], [n], [0], [0.0], [-1], [-1]
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            start, end = starts[node], ends[node]
+            if end - start <= leaf_size:
+                continue
+
+            # split the node at the median of its widest axis
+            points = locations[self.order[start:end]]
+            dim = int(np.argmax(np.ptp(points, axis=0)))
+            mid = (end - start) // 2
+            part = np.argpartition(points[:, dim], mid)
+            self.order[start:end] = self.order[start:end][part]
+
+            dims[node] = dim
+            splits[node] = float(locations[self.order[start + mid], dim])
+            lefts[node] = len(starts)
+            rights[node] = len(starts) + 1
+            for child_start, child_end in ((start, start + mid), (start + mid, end)):
+                starts.append(child_start)
+                ends.append(child_end)
+                dims.append(0)
+                splits.append(0.0)
+                lefts.append(-1)
+                rights.append(-1)
+            stack.extend((lefts[node], rights[node]))
+
+        self.starts = np.array(starts, dtype=np.int64)
+        self.ends = np.array(ends, dtype=np.int64)
+        self.dims = np.array(dims, dtype=np.int64)
+        self.splits = np.array(splits, dtype=np.float64)
+        self.lefts = np.array(lefts, dtype=np.int64)
+        self.rights = np.array(rights, dtype=np.int64)
+
+    def find_n(self, loc, n):
+        import heapq
+        loc = np.asarray(loc, dtype=np.float64)
+        n = min(n, len(self))
+        if n == 0:
+            return concat_ids([]), concat_distances([])
+
+        # max heap of the best candidates, stored as (-distance, id)
+        # stack holds (node, lower bound of the distance to the node)
+        best = []
+        stack = [(0, 0.0)]
+        while stack:
+            node, bound = stack.pop()
+            if len(best) == n and bound >= -best[0][0]:
+                continue
+            if self.lefts[node] == -1:
+                ids, distances = self._leaf(node, loc)
+                for photon_id, distance in zip(ids, distances):
+                    if len(best) < n:
+                        heapq.heappush(best, (-distance, photon_id))
+                    elif distance < -best[0][0]:
+                        heapq.heapreplace(best, (-distance, photon_id))
+                continue
+
+            # visit the nearer child first, the farther one only if it may be closer
+            diff = loc[self.dims[node]] - self.splits[node]
+            near, far = self.lefts[node], self.rights[node]
+            if diff > 0:
+                near, far = far, near
+            stack.append((far, max(bound, abs(diff))))
+            stack.append((near, bound))
+
+        best.sort(reverse=True)
+        ids = np.array([photon_id for _, photon_id in best], dtype=np.int64)
+        distances = np.array([-distance for distance, _ in best], dtype=np.float64)
+        return ids, distances
+
+    def find_range(self, loc, r):
+        loc = np.asarray(loc, dtype=np.float64)
+        ids = []
+        distances = []
+        stack = [0] if len(self) else []
+        while stack:
+            node = stack.pop()
+            if self.lefts[node] == -1:
+                leaf_ids, leaf_distances = self._leaf(node, loc)
+                inside = leaf_distances <= r
+                ids.append(leaf_ids[inside])
+                distances.append(leaf_distances[inside])
+                continue
+
+            # left child holds values <= split, right child values >= split
+            diff = loc[self.dims[node]] - self.splits[node]
+            if diff <= r:
+                stack.append(self.lefts[node])
+            if -diff <= r:
+                stack.append(self.rights[node])
+        return concat_ids(ids), concat_distances(distances)
+
+    # ids and distances of all the locations in a leaf
+    def _leaf(self, node, loc):
+        ids = self.order[self.starts[node]:self.ends[node]]
+        diff = self.locations[ids] - loc
+        return ids, np.sqrt(np.einsum("ij,ij->i", diff, diff))
+
+
+# Uniform grid for fixed-radius queries, cells are cubes of cell_size
+# Locations are sorted by the key of their cell, cell_keys are the sorted
+# keys of the occupied cells only, and cell_starts[i] is the offset of the
+# first location of cell cell_keys[i] in self.order, so the locations of
+# that cell are order[cell_starts[i]:cell_starts[i + 1]]
+# A query with r <= cell_size only needs to scan the 27 neighbor cells
+# max_cells bounds the number of cells so that keys fit in int64,
+# cell_size grows if needed
+class HashGrid(SpatialIndex):
+    backend = "grid"
+    state = ["origin", "cell_size", "dims", "order", "cell_keys", "cell_starts"]
+
+    def __init__(self, locations, cell_size, max_cells=2 ** 48):
+        super().__init__(locations, cell_size=cell_size, max_cells=max_cells)
+        locations = np.asarray(locations, dtype=np.float64).reshape(-1, 3)
+        self.origin = locations.min(axis=0) if len(locations) else np.zeros(3)
+        extent = locations.max(axis=0) - self.origin if len(locations) else np.zeros(3)
+
+        # a larger cell is still correct, it only scans more locations
+        self.cell_size = float(cell_size)
+        self.dims = (extent // self.cell_size).astype(np.int64) + 1
+        while np.prod(self.dims) > max_cells:
+            self.cell_size *= (np.prod(self.dims) / max_cells) ** (1 / 3) * 1.01
+            self.dims = (extent // self.cell_size).astype(np.int64) + 1
+
+        keys = self._keys(self._cells(locations))
+        self.order = np.argsort(keys, kind="stable")
+        self.cell_keys, counts = np.unique(keys[self.order], return_counts=True)
+        self.cell_starts = np.zeros(len(self.cell_keys) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.cell_starts[1:])
+
+    # integer cell coordinates of (N, 3) locations
+    def _cells(self, locations):
+        return np.floor((locations - self.origin) / self.cell_size).astype(np.int64)
+
+    # key of (N, 3) cell coordinates, which must be inside the grid
+    def _keys(self, cells):
+        return (cells[..., 0] * self.dims[1] + cells[..., 1]) * self.dims[2] + cells[..., 2]
+
+    def find_n(self, loc, n):
+        n = min(n, len(self))
+        if n == 0:
+            return concat_ids([]), concat_distances([])
+
+        # grow the radius until it holds n locations
+        # n nearest locations are all within the radius once it holds n
+        r = self.cell_size
+        while True:
+            ids, distances = self.find_range(loc, r)
+            if len(ids) >= n:
+                nearest = np.argsort(distances, kind="stable")[:n]
+                return ids[nearest], distances[nearest]
+            r *= 2
+
+    def find_range(self, loc, r):
+        _, ids, distances = self.find_range_batch(loc, r)
+        return ids, distances
+
+    # queries are processed chunk_size at a time, and the candidates of a chunk
+    # about max_candidates at a time, dense regions hold many per query
+    def find_range_batch(self, locations, r, chunk_size=4096, max_candidates=2 ** 22):
+        locations = np.asarray(locations, dtype=np.float64).reshape(-1, 3)
+
+        # neighbor cell offsets, 27 cells when r <= cell_size
+        reach = max(1, int(np.ceil(r / self.cell_size)))
+        steps = np.arange(-reach, reach + 1)
+        neighbors = np.stack(np.meshgrid(steps, steps, steps, indexing="ij"), -1).reshape(-1, 3)
+
+        counts = np.zeros(len(locations), dtype=np.int64)
+        ids = []
+        distances = []
+        # process queries in chunks to bound the size of the candidate arrays
+        for start in range(0, len(locations), chunk_size):
+            queries = locations[start:start + chunk_size]
+
+            # all the neighbor cells of all the queries, query-major order
+            cells = self._cells(queries)[:, None, :] + neighbors[None, :, :]
+            inside = np.all((cells >= 0) & (cells < self.dims), axis=-1)
+            query_ids = np.nonzero(inside)[0]
+            keys = self._keys(cells[inside])
+
+            # only the occupied cells have a key
+            slots = np.searchsorted(self.cell_keys, keys)
+            occupied = slots < len(self.cell_keys)
+            occupied[occupied] = self.cell_keys[slots[occupied]] == keys[occupied]
+            query_ids = query_ids[occupied]
+            slots = slots[occupied]
+
+            cell_begin = self.cell_starts[slots]
+            cell_counts = self.cell_starts[slots + 1] - cell_begin
+
+            # split the queries into groups of about max_candidates candidates
+            query_candidates = np.bincount(query_ids, weights=cell_counts, minlength=len(queries))
+            query_groups = (np.cumsum(query_candidates) // max_candidates).astype(np.int64)
+            cell_groups = query_groups[query_ids]
+            group_starts = np.searchsorted(cell_groups, np.unique(cell_groups))
+            group_ends = np.append(group_starts[1:], len(cell_groups))
+
+            for group_start, group_end in zip(group_starts, group_ends):
+                group_begin = cell_begin[group_start:group_end]
+                group_counts = cell_counts[group_start:group_end]
+
+                # expand the location range of each cell into candidate positions
+                candidate_queries = np.repeat(query_ids[group_start:group_end], group_counts)
+                first = np.cumsum(group_counts) - group_counts
+                positions = np.arange(group_counts.sum()) + np.repeat(group_begin - first, group_counts)
+                candidates = self.order[positions]
+
+                diff = self.locations[candidates] - queries[candidate_queries]
+                candidate_distances = np.sqrt(np.einsum("ij,ij->i", diff, diff))
+                keep = candidate_distances <= r
+
+                counts[start:start + chunk_size] += \
+                    np.bincount(candidate_queries[keep], minlength=len(queries))
+                ids.append(candidates[keep])
+                distances.append(candidate_distances[keep])
+
+        offsets = np.zeros(len(locations) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return offsets, concat_ids(ids), concat_distances(distances)
+
+
+# Concatenate a list of id or distance arrays, allowing an empty list
+def concat_ids(arrays):
+    return np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int64)
+
+def concat_distances(arrays):
+    return np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.float64)
+
+
+# Name of each backend and the index class
+BACKENDS = {
+    "mathutils": MathutilsKDTree,
+    "scipy": ScipyKDTree,
+    "numpy": NumpyKDTree,
+    "grid": HashGrid,
+}
+
+# Order to try the backends when none is given
+# grid is never chosen automatically since it needs a cell_size
+DEFAULT_BACKENDS = ["mathutils", "scipy", "numpy"]
+
+
+# Load an index saved by SpatialIndex.save() over the same locations
+# skipping the build, return None if it was saved for another number of
+# locations or by an older version of the index, or can not be read
+def load_index(path, locations):
+    import zipfile
+    try:
+        return read_index(np.load(path), locations)
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        print(f'Skip unreadable index {path}')
+        return None
+
+
+# Build an index from the arrays of a file saved by SpatialIndex.save()
+# the arrays are read lazily, so corrupted ones raise here
+def read_index(arrays, locations):
+    if int(arrays["count"]) != len(locations):
+        return None
+
+    cls = BACKENDS[str(arrays["backend"])]
+    options = {}
+    for key in arrays.files:
+        if key.startswith("option_"):
+            options[key[len("option_"):]] = arrays[key].item()
+
+    # saved by an older version of the index
+    if any(name not in arrays.files for name in cls.state):
+        return None
+
+    index = cls.__new__(cls)
+    SpatialIndex.__init__(index, locations, **options)
+    for name in cls.state:
+        value = arrays[name]
+        setattr(index, name, value.item() if value.ndim == 0 else value)
+    return index
+
+
+# Return the name of the first backend that can be imported
+# The PHOTON_MAP_BACKEND environment variable overrides the choice,
+# it must be one of DEFAULT_BACKENDS, which need no options
+def default_backend():
+    import os
+    backend = os.environ.get("PHOTON_MAP_BACKEND")
+    if backend:
+        if backend not in DEFAULT_BACKENDS:
+            raise ValueError(f'PHOTON_MAP_BACKEND must be one of {DEFAULT_BACKENDS}, not {backend}')
+        return backend
+
+    for backend in DEFAULT_BACKENDS:
+        try:
+            if backend == "mathutils":
+                import mathutils.kdtree
+            elif backend == "scipy":
+                import scipy.spatial
+            return backend
+        except ImportError:
+            continue
+    return "numpy"
+
+
+# Build a spatial index over an (N, 3) array of locations
+# backend is one of BACKENDS, or None to choose at runtime
+# options are passed to the index, e.g. workers for scipy
+def build_index(locations, backend=None, **options):
+    if backend is None:
+        backend = default_backend()
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown spatial index backend: {backend}')
+    return BACKENDS[backend](locations, **options)
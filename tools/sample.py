@@ -1,64 +1,364 @@
 import numpy as np
 
+# Philox4x32-10 constants
+PHILOX_M0, PHILOX_M1 = np.uint64(0xD2511F53), np.uint64(0xCD9E8D57)
+PHILOX_W0, PHILOX_W1 = np.uint64(0x9E3779B9), np.uint64(0xBB67AE85)
+MASK_32 = np.uint64(0xFFFFFFFF)
+
+# Return the 2-word Philox key of a seed, an int, None (fresh entropy)
+# or SeedSequence entropy
+def stream_key(seed=None):
+    return np.random.SeedSequence(seed).generate_state(2, dtype=np.uint32)
+
+# Counter-based random numbers: the Philox4x32-10 bijection of counters
+# under key, so any counter can be drawn directly, in any order and by any
+# worker, and always gives the same numbers
+# counters is a (..., 4) array of 32-bit words, key the 2 words of stream_key()
+# Return the (..., 4) uint32 random words
+def philox(counters, key):
+    c0, c1, c2, c3 = [np.asarray(counters[..., i], dtype=np.uint64) for i in range(4)]
+    k0, k1 = np.uint64(key[0]), np.uint64(key[1])
+
+    for _ in range(10):
+        p0 = c0 * PHILOX_M0
+        p1 = c2 * PHILOX_M1
+        c0, c1, c2, c3 = (p1 >> np.uint64(32)) ^ c1 ^ k0, p1 & MASK_32, \
+            (p0 >> np.uint64(32)) ^ c3 ^ k1, p0 & MASK_32
+        k0 = (k0 + PHILOX_W0) & MASK_32
+        k1 = (k1 + PHILOX_W1) & MASK_32
+
+    return np.stack((c0, c1, c2, c3), axis=-1).astype(np.uint32)
+
+# Return (N, num) uniform samples in [0, 1) of the stream of key, row i is
+# keyed by the counter (word0[i], word1[i], word2[i], bounce[i]), e.g.
+# (pixel, sample, path, bounce) or (photon, light, path, bounce)
+# The words are (N,) int arrays or ints, offset selects the first of the
+# num dimensions, so different decisions of a bounce get independent numbers
+def counter_uniforms(key, word0, word1, word2, bounce, num, offset=0):
+    word0, word1, word2, bounce = np.broadcast_arrays(
+        *[np.atleast_1d(np.asarray(w, dtype=np.int64)) for w in (word0, word1, word2, bounce)])
+
+    # 4 numbers per block, 256 blocks per bounce
+    first_block, last_block = offset // 4, (offset + num - 1) // 4
+    blocks = np.arange(first_block, last_block + 1)
+
+    counters = np.empty(word0.shape + (len(blocks), 4), dtype=np.uint64)
+    counters[..., 0] = (word0 & 0xFFFFFFFF)[:, None]
+    counters[..., 1] = (word1 & 0xFFFFFFFF)[:, None]
+    counters[..., 2] = (word2 & 0xFFFFFFFF)[:, None]
+    counters[..., 3] = ((bounce * 256)[:, None] + blocks) & 0xFFFFFFFF
+
+    words = philox(counters, key).reshape(len(word0), -1)
+    start = offset - first_block * 4
+    return words[:, start:start + num] * 2.0 ** -32
+
+# Number the paths spawned at a bounce, for the path word of counter_uniforms()
+# The spawned paths of every id (e.g. a photon or a camera ray) are numbered
+# 0, 1, ... in the order of (parent path, branch), so they stay unique and
+# small at any depth, unlike parent path * #branches + branch, and do not
+# depend on how the ids are batched
+# ids, parent_paths, branches are (N,) int arrays, the parent paths of an id
+# must be unique per branch
+# Return the (N,) paths
+def branch_paths(ids, parent_paths, branches):
+    ids = np.asarray(ids)
+    order = np.lexsort((branches, parent_paths, ids))
+    sorted_ids = ids[order]
+    firsts = np.flatnonzero(np.concatenate(([True], sorted_ids[1:] != sorted_ids[:-1])))
+    counts = np.diff(np.append(firsts, len(ids)))
+    paths = np.empty(len(ids), dtype=np.int64)
+    paths[order] = np.arange(len(ids)) - np.repeat(firsts, counts)
+    return paths
+
+# Low-discrepancy sequences
+# Sobol and Halton points cover the sample space more evenly than random
+# numbers, every pixel (and path of a pixel) gets its own randomized copy
+# of the sequence so the remaining error is noise instead of patterns
+
+# Primitive polynomials and initial direction numbers of the first dimensions
+# of the Sobol sequence, from Joe and Kuo's new-joe-kuo-6.21201
+# The first dimension is the van der Corput sequence
+SOBOL_DIRECTIONS = [
+    (1, ()),
+    (3, (1,)),
+    (7, (1, 3)),
+    (11, (1, 3, 1)),
+    (13, (1, 1, 1)),
+    (19, (1, 1, 3, 3)),
+    (25, (1, 3, 5, 13)),
+    (37, (1, 1, 5, 5, 17)),
+    (41, (1, 1, 5, 5, 5)),
+    (47, (1, 1, 7, 11, 19)),
+    (55, (1, 1, 5, 1, 1)),
+    (59, (1, 1, 1, 3, 11)),
+    (61, (1, 3, 5, 5, 31)),
+    (67, (1, 3, 3, 9, 7, 49)),
+    (91, (1, 1, 1, 15, 21, 21)),
+    (97, (1, 3, 1, 13, 27, 49)),
+    (103, (1, 1, 1, 15, 7, 5)),
+    (109, (1, 3, 1, 15, 13, 25)),
+    (115, (1, 1, 5, 5, 19, 61)),
+    (131, (1, 3, 7, 11, 23, 15, 103)),
+    (137, (1, 3, 7, 13, 13, 15, 69)),
+    (143, (1, 1, 3, 13, 7, 35, 63)),
+    (145, (1, 3, 5, 9, 1, 25, 53)),
+    (157, (1, 3, 1, 13, 9, 35, 107)),
+    (167, (1, 3, 1, 5, 27, 61, 31)),
+    (171, (1, 1, 5, 11, 19, 41, 61)),
+    (185, (1, 3, 5, 3, 3, 13, 69)),
+    (191, (1, 1, 7, 13, 1, 19, 1)),
+    (193, (1, 3, 7, 5, 13, 19, 59)),
+    (203, (1, 1, 3, 9, 25, 29, 41)),
+    (211, (1, 3, 5, 13, 23, 1, 55)),
+    (213, (1, 3, 7, 3, 13, 59, 17)),
+    (229, (1, 3, 1, 3, 5, 53, 69)),
+    (239, (1, 1, 5, 5, 23, 33, 13)),
+    (241, (1, 1, 7, 7, 1, 61, 123)),
+    (247, (1, 1, 7, 9, 13, 61, 49)),
+    (253, (1, 3, 3, 5, 3, 55, 33)),
+    (285, (1, 3, 1, 15, 31, 13, 49, 245)),
+    (299, (1, 3, 5, 15, 31, 59, 63, 97)),
+    (301, (1, 3, 1, 11, 11, 11, 77, 249)),
+    (333, (1, 3, 1, 11, 27, 43, 71, 9)),
+    (351, (1, 1, 7, 15, 21, 11, 81, 45)),
+    (355, (1, 3, 7, 3, 25, 31, 65, 79)),
+    (357, (1, 3, 1, 1, 19, 11, 3, 205)),
+    (361, (1, 1, 5, 9, 19, 21, 29, 157)),
+    (369, (1, 3, 7, 11, 1, 33, 89, 185)),
+    (391, (1, 3, 3, 3, 15, 9, 79, 71)),
+    (397, (1, 3, 7, 11, 15, 39, 119, 27)),
+    (425, (1, 1, 3, 1, 11, 31, 97, 225)),
+    (451, (1, 1, 1, 3, 23, 43, 57, 177)),
+    (463, (1, 3, 7, 7, 17, 17, 37, 71)),
+    (487, (1, 3, 1, 5, 27, 63, 123, 213)),
+    (501, (1, 1, 3, 5, 11, 43, 53, 133)),
+    (529, (1, 3, 5, 5, 29, 17, 47, 173, 479)),
+    (539, (1, 3, 3, 11, 3, 1, 109, 9, 69)),
+    (545, (1, 1, 1, 5, 17, 39, 23, 5, 343)),
+    (557, (1, 3, 1, 5, 25, 15, 31, 103, 499)),
+    (563, (1, 1, 1, 11, 11, 17, 63, 105, 183)),
+    (601, (1, 1, 5, 11, 9, 29, 97, 231, 363)),
+    (607, (1, 1, 5, 15, 19, 45, 41, 7, 383)),
+    (617, (1, 3, 7, 7, 31, 19, 83, 137, 221)),
+    (623, (1, 1, 1, 3, 23, 15, 111, 223, 83)),
+    (631, (1, 1, 5, 13, 31, 15, 55, 25, 161)),
+    (637, (1, 1, 3, 13, 25, 47, 39, 87, 257)),
+]
+
+# Return the (#dimensions, 32) uint32 generator matrices of the Sobol sequence,
+# column b of a dimension is XORed into a point when bit b of its index is set
+def sobol_matrices():
+    matrices = np.zeros((len(SOBOL_DIRECTIONS), 32), dtype=np.uint32)
+    matrices[0] = 1 << (31 - np.arange(32, dtype=np.uint64))
+    for dim, (poly, m) in enumerate(SOBOL_DIRECTIONS[1:], 1):
+        s = len(m)
+        a = (poly >> 1) & ((1 << (s - 1)) - 1)
+        v = [m[i] << (31 - i) for i in range(s)]
+        for i in range(s, 32):
+            v.append(v[i - s] ^ (v[i - s] >> s))
+            for k in range(1, s):
+                v[i] ^= ((a >> (s - 1 - k)) & 1) * v[i - k]
+        matrices[dim] = v
+    return matrices
+
+SOBOL_MATRICES = sobol_matrices()
+
+# Return the first n primes, the bases of the Halton dimensions
+def first_primes(n):
+    primes = []
+    candidate = 2
+    while len(primes) < n:
+        if all(candidate % p for p in primes if p * p <= candidate):
+            primes.append(candidate)
+        candidate += 1
+    return primes
+
+# Bases and digit permutations of the Halton dimensions, the permutations
+# break the correlation between dimensions with large bases
+# Digit 0 is kept so trailing zeros of an index add nothing
+HALTON_PRIMES = first_primes(len(SOBOL_DIRECTIONS))
+HALTON_PERMUTATIONS = [np.concatenate(([0], 1 + np.random.default_rng(base).permutation(base - 1)))
+                       for base in HALTON_PRIMES]
+
+# Reverse the bits of a uint32 array
+def reverse_bits(x):
+    x = np.asarray(x, dtype=np.uint32)
+    x = ((x >> np.uint32(1)) & np.uint32(0x55555555)) | ((x & np.uint32(0x55555555)) << np.uint32(1))
+    x = ((x >> np.uint32(2)) & np.uint32(0x33333333)) | ((x & np.uint32(0x33333333)) << np.uint32(2))
+    x = ((x >> np.uint32(4)) & np.uint32(0x0F0F0F0F)) | ((x & np.uint32(0x0F0F0F0F)) << np.uint32(4))
+    x = ((x >> np.uint32(8)) & np.uint32(0x00FF00FF)) | ((x & np.uint32(0x00FF00FF)) << np.uint32(8))
+    return (x >> np.uint32(16)) | (x << np.uint32(16))
+
+# Hash-based Owen scrambling (Burley 2020, Practical Hash-based Owen
+# Scrambling) of the uint32 arrays x, one scramble per seed
+# Flips every bit depending on the higher bits only, so scrambled Sobol
+# points keep their stratification
+def owen_scramble(x, seed):
+    x = reverse_bits(x)
+    seed = np.asarray(seed, dtype=np.uint32)
+    with np.errstate(over="ignore"):
+        x ^= x * np.uint32(0x3d20adea)
+        x += seed
+        x *= (seed >> np.uint32(16)) | np.uint32(1)
+        x ^= x * np.uint32(0x05526c56)
+        x ^= x * np.uint32(0x53a22864)
+    return reverse_bits(x)
+
+# Return the uint32 Sobol points of the indices in dimension dim
+def sobol_points(index, dim):
+    index = np.asarray(index, dtype=np.uint32)
+    points = np.zeros(index.shape, dtype=np.uint32)
+    for b in range(32):
+        points ^= np.where((index >> np.uint32(b)) & np.uint32(1), SOBOL_MATRICES[dim, b], np.uint32(0))
+    return points
+
+# Return the points of the indices in dimension dim of the Halton sequence,
+# the radical inverse in the prime base of the dimension
+def halton_points(index, dim):
+    base, permutation = HALTON_PRIMES[dim], HALTON_PERMUTATIONS[dim]
+    index = np.asarray(index, dtype=np.int64)
+    points = np.zeros(index.shape)
+    scale = 1 / base
+    while np.any(index):
+        points += permutation[index % base] * scale
+        index = index // base
+        scale /= base
+    return points
+
+# Return (N, num) uniform samples of dimensions first_dim, ..., of sample
+# samples[i] of the sequence of (ids[i], paths[i]) for row i, e.g. the
+# pixel, sample and path of a camera ray
+# kind is "sobol" (Owen scrambled, with the samples shuffled per pixel) or
+# "halton" (permuted digits, shifted per pixel)
+# Dimensions past the tables get counter-based random numbers
+def sequence_uniforms(kind, key, ids, samples, paths, first_dim, num):
+    ids, samples, paths = np.broadcast_arrays(
+        *[np.atleast_1d(np.asarray(w, dtype=np.int64)) for w in (ids, samples, paths)])
+    dims = first_dim + np.arange(num)
+
+    # one random seed per row and dimension, and one to shuffle the samples
+    counters = np.empty(ids.shape + (num + 1, 4), dtype=np.uint64)
+    counters[..., 0] = (ids & 0xFFFFFFFF)[:, None]
+    counters[..., 1] = 0xFFFFFFFF  # not a sample number of counter_uniforms()
+    counters[..., 2] = (paths & 0xFFFFFFFF)[:, None]
+    counters[..., 3] = np.append(dims, 0xFFFFFFFF)
+    seeds = philox(counters, key)[..., 0]
+
+    res = np.empty((len(ids), num))
+    for i, dim in enumerate(dims):
+        if dim >= len(SOBOL_DIRECTIONS):
+            res[:, i] = counter_uniforms(key, ids, samples, paths, 0xFFFFFF, 1, dim)[:, 0]
+        elif kind == "sobol":
+            index = owen_scramble(samples & 0xFFFFFFFF, seeds[:, num])
+            res[:, i] = owen_scramble(sobol_points(index, dim), seeds[:, i]) * 2.0 ** -32
+        elif kind == "halton":
+            res[:, i] = (halton_points(samples, dim) + seeds[:, i] * 2.0 ** -32) % 1
+        else:
+            raise ValueError(f"Unknown sequence {kind}")
+    return res
+
 # Sample n 3D direction uniformly on sphere
-# norm is the sphere direction, np array
+# norm is the sphere direction, np array of shape (3,) shared by all samples
+# or (n, 3) with one direction per sample
 # ratio [0, 1] is the ratio of theta we are sampling
 # ratio = 1 is sphere, 0.5 is hemisphere, 0 is single point
+# u is an optional (n, 2) array of uniform samples, e.g. from counter_uniforms()
 # Return n normalized dir samples
-def sample_dirs(n, norm, ratio):
-    res = np.zeros((n, 3))
+def sample_dirs(n, norm, ratio, u=None):
+    if u is None:
+        u = np.random.rand(n, 2)
 
     # compute 2 orthogonal directions (x, y) to norm
     x_axis, y_axis = build_coordinate(norm)
 
-    for i in range(n):
-        # theta is altitute cos(theta): [-1, 1]
-        cos_theta = np.random.rand() * 2 * ratio + (1 - 2 * ratio)
-        sin_theta = np.sqrt(1 - cos_theta * cos_theta)
+    # theta is altitute cos(theta): [-1, 1]
+    cos_theta = u[:, 0] * 2 * ratio + (1 - 2 * ratio)
+    sin_theta = np.sqrt(1 - cos_theta * cos_theta)
 
-        # phi is longitute [0, 2*pi]
-        phi = 2 * np.pi * np.random.rand()
+    # phi is longitute [0, 2*pi]
+    phi = 2 * np.pi * u[:, 1]
 
-        # Compute the sampled direction based on x, y and z (norm) axis
-        res[i] = sin_theta * np.cos(phi) * x_axis + \
-        sin_theta * np.sin(phi) * y_axis + cos_theta * norm
+    # Compute the sampled direction based on x, y and z (norm) axis
+    return (sin_theta * np.cos(phi))[:, None] * x_axis + \
+        (sin_theta * np.sin(phi))[:, None] * y_axis + cos_theta[:, None] * norm
 
-    return res
+# Importance sample n directions from the Phong lobe cos(alpha)^exponent,
+# alpha is the angle to axis, (3,) or (n, 3) like norm in sample_dirs
+# exponent = 1 is the cosine-weighted hemisphere of a diffuse surface,
+# higher exponents concentrate around axis, e.g. a glossy reflection
+# u is optional like in sample_dirs
+# Return the (n, 3) directions and their (n,) pdfs over solid angle
+def sample_phong_dirs(n, axis, exponent, u=None):
+    if u is None:
+        u = np.random.rand(n, 2)
+
+    # compute 2 orthogonal directions (x, y) to axis
+    x_axis, y_axis = build_coordinate(axis)
+
+    # cos(alpha) with density proportional to cos(alpha)^exponent * sin(alpha)
+    cos_alpha = u[:, 0] ** (1 / (exponent + 1))
+    sin_alpha = np.sqrt(1 - cos_alpha * cos_alpha)
+    phi = 2 * np.pi * u[:, 1]
+
+    dirs = (sin_alpha * np.cos(phi))[:, None] * x_axis + \
+        (sin_alpha * np.sin(phi))[:, None] * y_axis + cos_alpha[:, None] * axis
+    pdfs = (exponent + 1) / (2 * np.pi) * cos_alpha ** exponent
+    return dirs, pdfs
+
+# Importance sample n directions from the hemisphere around norm with
+# density cos(theta) / pi, so fewer samples are spent at grazing angles
+# Return the (n, 3) directions and their (n,) pdfs
+def sample_cosine_dirs(n, norm, u=None):
+    return sample_phong_dirs(n, norm, 1, u)
 
 # Sample on a 2D disk area defined by norm and radius
+# norm is (3,) or (n, 3) and u is optional like in sample_dirs
 # return the n sample positions
-def sample_disk_loc(n, norm, radius):
-    res = np.zeros((n, 3))
+def sample_disk_loc(n, norm, radius, u=None):
+    if u is None:
+        u = np.random.rand(n, 2)
 
     # compute 2 orthogonal directions (x, y) to norm
     x_axis, y_axis = build_coordinate(norm)
 
-    for i in range(n):
-        r = np.sqrt(np.random.rand()) * radius
-        theta = 2 * np.pi * np.random.rand()
-        res[i] = r * np.cos(theta) * x_axis + \
-         r * np.sin(theta) * y_axis
-
-    return res
+    r = np.sqrt(u[:, 0]) * radius
+    theta = 2 * np.pi * u[:, 1]
+    return (r * np.cos(theta))[:, None] * x_axis + \
+        (r * np.sin(theta))[:, None] * y_axis
 
 
 # Return a boolean result with probability of p to be True
-def sample_bernoulli(p):
-    return np.random.binomial(1, p, 1)[0] == 1
+# p can be an array of probabilities, with u the matching uniform samples,
+# to decide all the events of a batch at once as a boolean mask
+def sample_bernoulli(p, u=None):
+    if u is None:
+        u = np.random.rand(*np.shape(p))
+    return u < p
+
+# Pick one of k exclusive events for each of n trials, e.g. the continuation
+# of a path with Russian roulette
+# p is (n, k) event probabilities with rows summing to at most 1,
+# u the (n,) uniform samples
+# Return the (n,) index of the chosen event of each trial, k if none happens
+def sample_choice(p, u=None):
+    if u is None:
+        u = np.random.rand(len(p))
+    return np.sum(u[:, None] >= np.cumsum(p, axis=1), axis=1)
 
 # Normalize a 1D numpy array
 def normalize(arr):
     return arr / np.linalg.norm(arr)
 
 # Compute 2 normalized orthogonal axis given one direction
+# norm is (3,), or (n, 3) to get the (n, 3) axes of n directions
 def build_coordinate(norm):
     # Choose a good x direction
-    x_axis = np.array([1., 0., 0.])
-    if np.abs(np.dot(x_axis, norm)) > 0.9:
-        x_axis = np.array([0., 1., 0.])
+    x_axis = np.zeros(np.shape(norm))
+    x_axis[..., 0] = 1
+    x_axis[np.abs(norm[..., 0]) > 0.9] = (0., 1., 0.)
 
-    x_axis -= np.dot(x_axis, norm) * norm
-    x_axis = normalize(x_axis)
+    x_axis -= np.sum(x_axis * norm, axis=-1, keepdims=True) * norm
+    x_axis /= np.linalg.norm(x_axis, axis=-1, keepdims=True)
 
     # Compute y direction from cross product
     y_axis = np.cross(x_axis, norm)
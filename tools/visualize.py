@@ -36,14 +36,14 @@ def convert_map_to_ply(map_path, ply_path, depth_filter=None):
     photons = np.array([],dtype=[('x','f4'), ('y','f4'), ('z','f4'), \
         ('nx','f4'), ('ny','f4'),('nz','f4')])
 
-    for i in range(len(photon_map.map)):
+    for i in range(len(photon_map)):
         # Can only save photons with specific depth
         if depth_filter:
-            if photon_map.map[i].depth != depth_filter:
+            if photon_map.depths[i] != depth_filter:
                 continue
 
-        l = photon_map.map[i].location
-        n = photon_map.map[i].direction
+        l = photon_map.locations[i]
+        n = photon_map.directions[i]
         photon = np.array([(l[0], l[1], l[2], n[0], n[1], n[2])], \
         dtype=[('x','f4'), ('y','f4'), ('z','f4'), \
         ('nx','f4'), ('ny','f4'), ('nz','f4')])